@@ -0,0 +1,282 @@
+'''
+Headless batch rendering of still images and turntable sequences.
+
+Renders one or more celestial bodies offscreen to PNG files, using the
+scenes of visTopo.py, visTopoWithSea.py (when a sea level is given) or
+visIsolines.py (with --isolines), and a view given on the command line.
+Bodies, and ranges of the frames of turntables, are spread over a pool of
+worker processes, each of which creates its scene once and renders all the
+frames it is given, while a background thread writes the finished frames.
+
+Every worker loads its own copy of a dataset, with all its levels of detail,
+and of the texture, so the number of workers is capped by a memory budget
+as well as by --workers.
+
+    python batchRender.py data/mars.dat data/moon.dat --out renders
+        [--tilt DEG] [--rot DEG] [--scale FACTOR]
+        [--sea-level KM | --isolines] [--turntable FRAMES]
+        [--size WIDTH HEIGHT] [--workers N] [--memory GiB]
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+import buildAll
+import datasets
+import textures
+import utils
+import visIsolines
+import visTopo
+import visTopoWithSea
+
+# Rough peak memory of a worker, measured on scenes of a few sizes: the
+# interpreter with VTK and an offscreen context loaded, plus this much per
+# sphere vertex of the finest level of detail (every level, the warped
+# copies and the mapper's buffers), per pixel of the frames, and per byte
+# of the texture level shown
+BASE_BYTES = 384 * 2**20
+BYTES_PER_VERTEX = 200
+BYTES_PER_PIXEL = 16
+TEXTURE_COPIES = 2
+
+
+class FrameWriter:
+    '''
+    Write frames to PNG files from a background thread, so rendering the
+    next frame overlaps with encoding the previous ones. At most `maxQueued`
+    frames wait to be written at once.
+    '''
+    def __init__(self, maxQueued=8):
+        self.queue = queue.Queue(maxQueued)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, frame = item
+            try:
+                # cv2 releases the GIL while encoding
+                if not cv2.imwrite(path, frame):
+                    raise OSError(f'Could not write {path}')
+            except Exception as e:
+                self.error = e
+
+    def write(self, path, frame):
+        self.queue.put((path, frame))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def captureFrame(renderWindow):
+    '''Render a window and return its image as a BGR array for cv2.'''
+    renderWindow.Render()
+    windowToImage = vtk.vtkWindowToImageFilter()
+    windowToImage.SetInput(renderWindow)
+    windowToImage.ReadFrontBufferOff()
+    windowToImage.Update()
+
+    image = windowToImage.GetOutput()
+    width, height, _ = image.GetDimensions()
+    pixels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    # VTK images start from the bottom row
+    return np.ascontiguousarray(
+        pixels.reshape(height, width, -1)[::-1, :, 2::-1]
+    )
+
+
+def setSlider(scene, name, value):
+    '''Move a slider of a scene, running its callbacks as if dragged.'''
+    slider = scene.sliders[name]
+    slider.GetRepresentation().SetValue(value)
+    slider.InvokeEvent(vtk.vtkCommand.InteractionEvent)
+
+
+def createScene(data, view, size):
+    '''Create the offscreen scene of a celestial body for a view.'''
+    if view['isolines']:
+        createFunction = visIsolines.createScene
+    elif view['seaLevel'] is not None:
+        createFunction = visTopoWithSea.createScene
+    else:
+        createFunction = visTopo.createScene
+
+    scene = createFunction(data, offScreen=True)
+    scene.renderWindow.SetSize(*size)
+
+    if view['scale'] is not None and 'relief scale factor' in scene.sliders:
+        setSlider(scene, 'relief scale factor', view['scale'])
+    if view['seaLevel'] is not None and 'sea level' in scene.sliders:
+        setSlider(scene, 'sea level', view['seaLevel'])
+
+    # The sliders are not shown in rendered images
+    for slider in scene.sliders.values():
+        slider.EnabledOff()
+    return scene
+
+
+def renderFrames(configFile, view, size, frames, turntableFrames, outPath):
+    '''
+    Render the given frames of a celestial body to PNG files, and return
+    their paths. Frame i of a turntable is seen from i / turntableFrames of
+    a full turn around the body.
+    '''
+    data = utils.readDataFile(configFile)
+    data = data._replace(**{
+        key: view[key] for key in ('tilt', 'rot') if view[key] is not None
+    })
+    scene = createScene(data, view, size)
+    camera = scene.renderer.GetActiveCamera()
+
+    writer = FrameWriter()
+    paths = []
+    try:
+        azimuth = 0
+        for frame in frames:
+            camera.Azimuth(frame * 360 / turntableFrames - azimuth)
+            azimuth = frame * 360 / turntableFrames
+            path = outPath(frame)
+            writer.write(path, captureFrame(scene.renderWindow))
+            paths.append(path)
+    finally:
+        writer.close()
+        scene.renderWindow.Finalize()
+    return paths
+
+
+def frameRanges(nFrames, nChunks):
+    '''Split frames 0 to nFrames - 1 into nChunks contiguous ranges.'''
+    bounds = np.linspace(0, nFrames, nChunks + 1).round().astype(int)
+    return [range(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def estimateSceneBytes(data, size):
+    '''
+    Return a rough estimate of the peak memory of a worker rendering a
+    celestial body at the given frame size.
+    '''
+    if data.mesh == 'icosphere':
+        vertices = 10 * utils.icosphereFrequency(int(data.res))**2
+    else:
+        vertices = data.res**2
+
+    shapes = textures.readLevelShapes(textures.cachedTexturePath(data))
+    textureBytes = 0
+    if shapes:
+        level = textures.pickLevel(
+            shapes, size, textures.DEFAULT_MAX_TEXTURE_SIZE
+        )
+        textureBytes = int(np.prod(shapes[level]))
+
+    return int(
+        BASE_BYTES + BYTES_PER_VERTEX * vertices
+        + BYTES_PER_PIXEL * size[0] * size[1] + TEXTURE_COPIES * textureBytes
+    )
+
+
+def prepare(configFile, view):
+    '''
+    Build the dataset, isolines if needed, and cached texture of a celestial
+    body, so that workers rendering it in parallel only read them from the
+    caches.
+    '''
+    data = utils.readDataFile(configFile)
+    datasetPath = datasets.ensureDataset(data)
+    textures.ensureTexture(data)
+    if view['isolines']:
+        visIsolines.readIsolines(data, datasetPath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('configs', nargs='+',
+                        help='config files of the celestial bodies')
+    parser.add_argument('--out', default='renders',
+                        help='directory to write the images to')
+    parser.add_argument('--tilt', type=float,
+                        help='axial tilt in degrees (default: from config)')
+    parser.add_argument('--rot', type=float,
+                        help='rotation in degrees (default: from config)')
+    parser.add_argument('--scale', type=float,
+                        help='relief scale factor (default: as viewers)')
+    # The isolines scene has no sea
+    sceneGroup = parser.add_mutually_exclusive_group()
+    sceneGroup.add_argument('--sea-level', type=float, dest='seaLevel',
+                            help='show the sea at this elevation in km')
+    sceneGroup.add_argument('--isolines', action='store_true',
+                            help='show isolines instead of relief')
+    parser.add_argument('--turntable', type=int, metavar='FRAMES',
+                        help='render a turntable of this many frames '
+                             'instead of a still')
+    parser.add_argument('--size', nargs=2, type=int, default=[1280, 720],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='maximum number of worker processes')
+    parser.add_argument('--memory', type=float,
+                        help='memory budget in GiB for the workers running '
+                             'at once (default: 80%% of physical memory)')
+    args = parser.parse_args()
+
+    view = {
+        'tilt': args.tilt, 'rot': args.rot, 'scale': args.scale,
+        'seaLevel': args.seaLevel, 'isolines': args.isolines,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    for configFile in args.configs:
+        prepare(configFile, view)
+
+    if args.memory is not None:
+        memoryBudget = args.memory * 2**30
+    else:
+        memoryBudget = (buildAll.totalMemory() or 2**63) * 0.8
+    sceneBytes = max(
+        estimateSceneBytes(utils.readDataFile(configFile), args.size)
+        for configFile in args.configs
+    )
+
+    # No more workers than fit in the memory budget, or than there are
+    # frames to render. Turntables are split so that there are about as
+    # many jobs as workers
+    nFrames = args.turntable or 1
+    workers = max(1, min(
+        args.workers, int(memoryBudget // sceneBytes),
+        nFrames * len(args.configs)
+    ))
+    if workers < args.workers:
+        print(f'Workers capped at {workers}, of about '
+              f'{sceneBytes / 2**20:.0f} MiB each')
+    chunksPerBody = max(1, -(-workers // len(args.configs)))
+
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = []
+        for configFile in args.configs:
+            stem = os.path.splitext(os.path.basename(configFile))[0]
+            if args.turntable:
+                os.makedirs(os.path.join(args.out, stem), exist_ok=True)
+                pattern = os.path.join(args.out, stem, f'{stem}_{{:04d}}.png')
+            else:
+                pattern = os.path.join(args.out, f'{stem}.png')
+
+            for frames in frameRanges(nFrames, chunksPerBody):
+                jobs.append(pool.submit(
+                    renderFrames, configFile, view, args.size, frames,
+                    nFrames, pattern.format
+                ))
+
+        for job in jobs:
+            for path in job.result():
+                print(f'Saved {path}')
@@ -0,0 +1,248 @@
+'''
+Benchmarks for the projection kernels in utils.py and the height sampling
+stage of readCylindricalTopo.py.
+
+Every benchmark is run on synthetic data over a sweep of sizes, and records
+its best wall time over a few repeats and its peak memory, as traced by
+tracemalloc (which includes NumPy arrays). The results are written to a JSON
+file, together with the commit they were measured on, so that runs from
+different commits can be compared:
+
+    python benchmark.py results.json [--quick] [--repeat N] [--only NAME]
+    python benchmark.py --compare before.json after.json
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+import readCylindricalTopo
+import utils
+
+
+def randomGeoCoords(n, rng, hemisphere=False):
+    '''Return n random (longitude, latitude) pairs in degrees.'''
+    lmbdaMax = 90 if hemisphere else 180
+    lmbdas = rng.uniform(-lmbdaMax, lmbdaMax, n)
+    phis = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    return lmbdas, phis
+
+
+def syntheticDem(height, rng):
+    '''
+    Return a smooth, equirectangular DEM of the given height (and twice the
+    width), with values in metres, and its value range.
+    '''
+    lmbdas = np.linspace(-np.pi, np.pi, 2 * height, dtype=np.float32)
+    phis = np.linspace(-np.pi / 2, np.pi / 2, height, dtype=np.float32)
+    dem = np.zeros((height, 2 * height), dtype=np.float32)
+    for _ in range(8):
+        kx, ky = rng.integers(1, 12, 2)
+        dem += (
+            np.sin(kx * lmbdas + rng.uniform(0, 2 * np.pi))[np.newaxis, :] *
+            np.cos(ky * phis + rng.uniform(0, 2 * np.pi))[:, np.newaxis]
+        )
+    dem *= 2000
+    return dem, (float(dem.min()), float(dem.max()))
+
+
+def benchOrthographic(n, rng):
+    lmbdas, phis = randomGeoCoords(n, rng, hemisphere=True)
+    return lambda: utils.orthographic(1000, lmbdas, phis)
+
+
+def benchInverseOrthographic(n, rng):
+    r = np.sqrt(rng.uniform(0, 1, n)) * 1000
+    theta = rng.uniform(0, 2 * np.pi, n)
+    xs, ys = r * np.cos(theta), r * np.sin(theta)
+    return lambda: utils.inverseOrthographic(xs, ys, 1000)
+
+
+def benchGeoToCartesian(n, rng):
+    lmbdas, phis = randomGeoCoords(n, rng)
+    return lambda: utils.geoToCartesian(1000, lmbdas, phis)
+
+
+def benchInterpColormap(n, rng):
+    colormap = rng.integers(0, 256, (n, 3)).astype(np.uint8)
+    return lambda: utils.interpColormap(colormap, 10, isHsv=True)
+
+
+def benchFindNearestColorIdx(n, rng):
+    colormap = utils.interpColormap(
+        rng.integers(0, 256, (40, 3)).astype(np.uint8), 10, isHsv=True
+    )
+    colors = rng.integers(0, 256, (n, 3)).astype(np.uint8)
+    return lambda: utils.findNearestColorIdx(
+        colors, colormap, metric=utils.ColorMetric.L2NORM, weights=[4, 1, 2]
+    )
+
+
+def benchHeightSampling(params, rng):
+    demHeight, res, sampling = params
+    dem, demRange = syntheticDem(demHeight, rng)
+    data = utils.PlanetData(
+        hMin=demRange[0], hMax=demRange[1], R=3389500, tilt=0, rot=0,
+        sfR=0.001, sf=1, topo='', texture='', vtksource='', res=res,
+        name='Benchmark', sampling=sampling
+    )
+    return lambda: readCylindricalTopo.sampleHeights(data, dem, demRange, res)
+
+
+# name: (setup function, full sweep, quick sweep, names of the parameters)
+BENCHMARKS = {
+    'orthographic': (
+        benchOrthographic, [10**4, 10**5, 10**6, 10**7],
+        [10**4, 10**5], ('n',)
+    ),
+    'inverseOrthographic': (
+        benchInverseOrthographic, [10**4, 10**5, 10**6, 10**7],
+        [10**4, 10**5], ('n',)
+    ),
+    'geoToCartesian': (
+        benchGeoToCartesian, [10**4, 10**5, 10**6, 10**7],
+        [10**4, 10**5], ('n',)
+    ),
+    'interpColormap': (
+        benchInterpColormap, [10, 100, 1000], [10, 100], ('n',)
+    ),
+    'findNearestColorIdx': (
+        benchFindNearestColorIdx, [10**3, 10**4, 10**5, 10**6],
+        [10**3, 10**4], ('n',)
+    ),
+    'heightSampling': (
+        benchHeightSampling,
+        [(h, res, s) for h in (512, 2048, 8192) for res in (250, 1000, 2000)
+         for s in ('nearest', 'bilinear')],
+        [(h, res, s) for h in (256, 512) for res in (100, 250)
+         for s in ('nearest', 'bilinear')],
+        ('demHeight', 'res', 'sampling')
+    ),
+}
+
+
+def measure(run, repeat):
+    '''
+    Return the best wall time of a benchmark over `repeat` runs, and the
+    peak memory allocated during a separate, traced run.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    return min(times), peakBytes
+
+
+def currentCommit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(names, quick=False, repeat=3, seed=0):
+    '''Run the named benchmarks and return their results.'''
+    results = []
+    for name in names:
+        setup, sweep, quickSweep, paramNames = BENCHMARKS[name]
+        for size in (quickSweep if quick else sweep):
+            run = setup(size, np.random.default_rng(seed))
+            seconds, peakBytes = measure(run, repeat)
+            del run
+
+            values = size if isinstance(size, tuple) else (size,)
+            result = {
+                'benchmark': name,
+                'params': dict(zip(paramNames, values)),
+                'seconds': seconds,
+                'peakBytes': peakBytes,
+            }
+            results.append(result)
+            print(
+                f'{name:<20} {formatParams(result["params"]):<40} '
+                f'{seconds:10.4f} s {peakBytes / 2**20:10.1f} MiB'
+            )
+    return results
+
+
+def formatParams(params):
+    return ', '.join(f'{k}={v}' for k, v in params.items())
+
+
+def compare(beforeFile, afterFile):
+    '''
+    Print the change in time and peak memory of every benchmark that was
+    run in both of the given result files.
+    '''
+    with open(beforeFile) as f:
+        before = json.load(f)
+    with open(afterFile) as f:
+        after = json.load(f)
+
+    def key(result):
+        params = json.dumps(result['params'], sort_keys=True)
+        return result['benchmark'], params
+
+    beforeResults = {key(r): r for r in before['results']}
+    print(f'{before["commit"]} -> {after["commit"]}')
+    for result in after['results']:
+        old = beforeResults.get(key(result))
+        if old is None:
+            continue
+        print(
+            f'{result["benchmark"]:<20} {formatParams(result["params"]):<40} '
+            f'time x{result["seconds"] / old["seconds"]:6.2f}  '
+            f'memory x{result["peakBytes"] / max(old["peakBytes"], 1):6.2f}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output', nargs='?', default='benchmark.json',
+                        help='file to write the results to')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run the smaller sizes of each sweep')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                        help='benchmark to run (may be given more than once)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = runBenchmarks(
+            args.only or list(BENCHMARKS), args.quick, args.repeat
+        )
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': currentCommit(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.platform(),
+                'quick': args.quick,
+                'results': results,
+            }, f, indent=2)
+        print(f'Saved {args.output}')
@@ -0,0 +1,175 @@
+'''
+Build the datasets of many celestial bodies in parallel.
+
+Each config file is built as readCylindricalTopo.py would build it, into the
+build cache, in its own worker process. Bodies whose dataset in the cache is
+already up to date are skipped, and builds are started as long as there are
+free workers and their estimated peak memory fits in the memory budget, so
+several large builds do not run at once on a small machine. A summary of
+every body is printed at the end.
+
+    python buildAll.py [data/*.dat] [--workers N] [--memory GiB] [--force]
+'''
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import glob
+import os
+import time
+
+import datasets
+import profiling
+import readCylindricalTopo
+import utils
+
+# Rough peak memory of a build: the interpreter with NumPy and VTK loaded,
+# plus this much per sphere vertex of the finest level of detail (points,
+# normals, heights, sampling coordinates and polygons)
+BASE_BYTES = 256 * 2**20
+BYTES_PER_VERTEX = 200
+# Images are decoded in full, and are assumed to be at most this many times
+# larger than their file
+IMAGE_EXPANSION = 8
+
+
+def estimateBuildBytes(data, directory='images'):
+    '''Return a rough estimate of the peak memory of building a dataset.'''
+    topoPath = os.path.join(directory, data.topo)
+    ext = os.path.splitext(data.topo)[1].lower()
+    if ext in ('.img', '.raw', '.npy'):
+        # Memory-mapped and read a tile at a time, then downsized by sf
+        topoBytes = os.path.getsize(topoPath) / data.sf**2 * 4 + 64 * 2**20
+    else:
+        topoBytes = os.path.getsize(topoPath) * IMAGE_EXPANSION
+    if data.mesh == 'icosphere':
+        vertices = 10 * utils.icosphereFrequency(int(data.res))**2
+    else:
+        vertices = data.res**2
+    return int(BASE_BYTES + topoBytes + BYTES_PER_VERTEX * vertices)
+
+
+def totalMemory():
+    '''Return the physical memory of the machine in bytes, if known.'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def build(configFile):
+    '''Build the datasets of a config in the build cache, without preview.'''
+    start = time.perf_counter()
+    data = utils.readDataFile(configFile)
+    path = datasets.cachedDatasetPath(data)
+    readCylindricalTopo.buildDataset(data, path)
+    return {
+        'path': path,
+        'seconds': time.perf_counter() - start,
+        'peakRssBytes': profiling.peakRss(),
+    }
+
+
+def startBuild(configFile):
+    '''
+    Start building a config in a new worker process, so that its peak
+    memory is measured on its own, and return the future of its result.
+    '''
+    executor = ProcessPoolExecutor(1)
+    future = executor.submit(build, configFile)
+    executor.shutdown(wait=False)
+    return future
+
+
+def buildAll(configFiles, workers, memoryBudget, force=False):
+    '''
+    Build the datasets of the given configs in parallel, and return a
+    summary of each body.
+    '''
+    summaries = {}
+    pending = []
+    for configFile in configFiles:
+        data = utils.readDataFile(configFile)
+        summary = {'name': data.name, 'config': configFile}
+        summaries[configFile] = summary
+
+        if not os.path.exists(os.path.join('images', data.topo)):
+            summary['status'] = 'missing topo'
+        elif os.path.exists(datasets.cachedDatasetPath(data)) and not force:
+            summary.update(
+                status='up to date', path=datasets.cachedDatasetPath(data)
+            )
+        else:
+            summary['estimateBytes'] = estimateBuildBytes(data)
+            pending.append(configFile)
+
+    # Largest builds first, so that they are not left running alone at the
+    # end while the small ones could have run beside them
+    pending.sort(key=lambda c: summaries[c]['estimateBytes'], reverse=True)
+
+    running = {}
+    while pending or running:
+        usedBytes = sum(
+            summaries[c]['estimateBytes'] for c in running.values()
+        )
+        for configFile in list(pending):
+            if len(running) >= workers:
+                break
+            estimate = summaries[configFile]['estimateBytes']
+            # A build that does not fit in the budget on its own is still
+            # run, but only once nothing else is running
+            if running and usedBytes + estimate > memoryBudget:
+                continue
+            print(f'Building {configFile}')
+            running[startBuild(configFile)] = configFile
+            pending.remove(configFile)
+            usedBytes += estimate
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            configFile = running.pop(future)
+            try:
+                summaries[configFile].update(future.result(), status='built')
+            except Exception as e:
+                summaries[configFile].update(status=f'failed: {e!r}')
+            print(f'{configFile}: {summaries[configFile]["status"]}')
+
+    return [summaries[c] for c in configFiles]
+
+
+def printSummary(summaries):
+    def mib(size):
+        return f'{size / 2**20:10.0f}' if size is not None else f'{"-":>10}'
+
+    print(
+        f'{"body":<12} {"status":<14} {"time (s)":>9} '
+        f'{"est. (MiB)":>10} {"peak (MiB)":>10}  dataset'
+    )
+    for summary in summaries:
+        seconds = summary.get('seconds')
+        print(
+            f'{summary["name"]:<12} {summary["status"]:<14} '
+            f'{f"{seconds:.1f}" if seconds is not None else "-":>9} '
+            f'{mib(summary.get("estimateBytes"))} '
+            f'{mib(summary.get("peakRssBytes"))}  {summary.get("path", "")}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('configs', nargs='*',
+                        help='config files to build (default: data/*.dat)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='maximum number of builds run at once')
+    parser.add_argument('--memory', type=float,
+                        help='memory budget in GiB for the builds running '
+                             'at once (default: 80%% of physical memory)')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild datasets that are up to date')
+    args = parser.parse_args()
+
+    configFiles = args.configs or sorted(glob.glob('data/*.dat'))
+    if args.memory is not None:
+        memoryBudget = args.memory * 2**30
+    else:
+        memoryBudget = (totalMemory() or 2**63) * 0.8
+
+    printSummary(buildAll(configFiles, args.workers, memoryBudget, args.force))
@@ -0,0 +1,317 @@
+'''
+Computing and caching the isolines (contour lines) of celestial body
+datasets.
+
+Isolines are made in one of two ways. When the topographic map a dataset was
+built from is available, they are traced with marching squares directly on
+its equirectangular height grid, for all levels at once, and projected onto
+the sphere afterwards; this is much faster than contouring the sphere mesh,
+and follows the terrain at the full resolution of the (downsized) map rather
+than of the mesh. Otherwise the dataset's sphere is contoured with
+vtkContourFilter, with the levels spread over a pool of worker processes.
+
+Isolines only depend on the dataset they are made from, so they are computed
+once and stored next to the dataset (`<dataset>_isolines.npz`). Each level
+is stored separately, so any subset of levels can be loaded without
+recomputing them, and levels missing from the cache are computed and added
+to it when first asked for.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import os
+import vtk
+from vtk.util import numpy_support
+
+import datasets
+import utils
+
+ISOLINE_KEYS = ('points', 'normals', 'offsets', 'connectivity')
+
+
+def isolinesPath(datasetPath):
+    '''Return the filename of the isoline cache of a dataset.'''
+    stem, _ = os.path.splitext(datasetPath)
+    return f'{stem}_isolines.npz'
+
+
+_workerDataset = None
+
+
+def _initWorker(datasetPath):
+    global _workerDataset
+    _workerDataset = datasets.readDataset(datasetPath)
+
+
+def contourLevel(value, polydata=None):
+    '''
+    Contour a dataset at a single height, returning the points, point
+    normals, and line cell offsets and connectivity of the isoline.
+
+    In worker processes the dataset loaded by the pool initializer is used.
+    '''
+    contour = vtk.vtkContourFilter()
+    contour.SetInputData(_workerDataset if polydata is None else polydata)
+    contour.SetValue(0, value)
+    contour.Update()
+    output = contour.GetOutput()
+
+    if output.GetNumberOfPoints() == 0:
+        return {
+            'points': np.zeros((0, 3), np.float32),
+            'normals': np.zeros((0, 3), np.float32),
+            'offsets': np.zeros(1, np.int64),
+            'connectivity': np.zeros(0, np.int64),
+        }
+
+    lines = output.GetLines()
+    return {
+        'points': numpy_support.vtk_to_numpy(output.GetPoints().GetData()),
+        'normals': numpy_support.vtk_to_numpy(
+            output.GetPointData().GetNormals()
+        ),
+        'offsets': numpy_support.vtk_to_numpy(lines.GetOffsetsArray()),
+        'connectivity': numpy_support.vtk_to_numpy(
+            lines.GetConnectivityArray()
+        ),
+    }
+
+
+def marchingSquares(grid: np.ndarray, values):
+    '''
+    Contour a 2D grid at each of the given values with vectorized marching
+    squares.
+
+    Returns a list with, for each value, an (M, 2, 2) array of the (x, y)
+    end points of its M line segments, in fractional column and row
+    coordinates of the grid. Saddle cells are resolved using the mean of
+    their four corners.
+    '''
+    # Corners of each cell, anticlockwise from the one at (row, col)
+    corners = np.stack([
+        grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]
+    ], axis=-1)
+    cellMin, cellMax = corners.min(axis=-1), corners.max(axis=-1)
+
+    # Edges run between these corners, and start from these cell offsets
+    edgeStarts = np.array([0, 1, 3, 0])
+    edgeEnds = np.array([1, 2, 2, 3])
+    edgeOrigins = np.array([[0, 0], [1, 0], [0, 1], [0, 0]])
+    edgeDirections = np.array([[1, 0], [0, 1], [1, 0], [0, 1]])
+
+    segments = []
+    for value in values:
+        rows, cols = np.nonzero((cellMin < value) & (cellMax >= value))
+        cellCorners = corners[rows, cols]
+        above = cellCorners >= value
+
+        start, end = cellCorners[:, edgeStarts], cellCorners[:, edgeEnds]
+        crossed = above[:, edgeStarts] != above[:, edgeEnds]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(crossed, (value - start) / (end - start), 0)
+
+        # (x, y) of the crossing point on each of the 4 edges of each cell
+        points = (
+            np.stack([cols, rows], axis=-1)[:, np.newaxis] +
+            edgeOrigins + t[..., np.newaxis] * edgeDirections
+        )
+
+        # Cells with two crossed edges have one segment between them
+        simple = crossed.sum(axis=-1) == 2
+        edges = np.nonzero(crossed[simple])[1].reshape(-1, 2)
+        simpleSegments = np.take_along_axis(
+            points[simple], edges[..., np.newaxis], axis=1
+        )
+
+        # Saddles have all four edges crossed and two segments, each cutting
+        # off one of the corners that are on the other side of the centre
+        saddle = ~simple
+        centreAbove = cellCorners[saddle].mean(axis=-1) >= value
+        cutOffFirst = centreAbove != above[saddle, 0]
+        pairs = np.where(
+            cutOffFirst[:, np.newaxis, np.newaxis],
+            [[0, 3], [1, 2]], [[0, 1], [2, 3]]
+        )
+        saddlePoints = points[saddle]
+        saddleSegments = np.concatenate([
+            np.take_along_axis(saddlePoints, pairs[:, i, :, np.newaxis], 1)
+            for i in range(2)
+        ])
+
+        segments.append(np.concatenate([simpleSegments, saddleSegments]))
+
+    return segments
+
+
+def gridIsolines(data, values, directory='images', tileBytes=64 * 2**20):
+    '''
+    Trace isolines at the given heights (in dataset units, i.e. metres
+    scaled by `sfR`) on the equirectangular topographic map of a celestial
+    body, and project them onto its sphere.
+
+    The map is contoured one band of rows at a time, so memory use stays
+    bounded for full resolution memory-mapped maps. Its first and last
+    columns both lie on the +-180 degree meridian, and its first and last
+    rows each collapse to a pole, so these are averaged so that isolines
+    meet across the seam and do not tangle up at the poles.
+    '''
+    grid, gridRange = utils.readTopoGrid(data, directory)
+    height, width = grid.shape
+
+    # Contour the map values that the heights are linearly mapped from
+    vMin, vMax = gridRange
+    scale = (vMax - vMin) / (data.hMax - data.hMin)
+    gridValues = [
+        (v / data.sfR - data.hMin) * scale + vMin for v in values
+    ]
+
+    bandRows = max(2, tileBytes // (width * 4 * 12))
+    segments = [[] for _ in values]
+    for start in range(0, height - 1, bandRows):
+        stop = min(start + bandRows, height - 1)
+        band = np.array(grid[start:stop + 1], dtype=np.float32)
+
+        band[:, 0] = band[:, -1] = (band[:, 0] + band[:, -1]) / 2
+        if start == 0:
+            band[0] = band[0].mean()
+        if stop == height - 1:
+            band[-1] = band[-1].mean()
+
+        for i, bandSegments in enumerate(marchingSquares(band, gridValues)):
+            bandSegments[..., 1] += start
+            segments[i].append(bandSegments)
+
+    isolines = {}
+    for value, levelSegments in zip(values, segments):
+        xy = np.concatenate(levelSegments).reshape(-1, 2)
+        lmbdas = xy[:, 0] * (360 / (width - 1)) - 180
+        phis = xy[:, 1] * (180 / (height - 1)) - 90
+        points = np.stack(
+            utils.geoToCartesian(data.R * data.sfR, lmbdas, phis), axis=-1
+        ).astype(np.float32).reshape(-1, 2, 3)
+
+        # Drop segments that collapse to a point, e.g. at the poles
+        points = points[np.any(points[:, 0] != points[:, 1], axis=-1)]
+        points = points.reshape(-1, 3)
+
+        isolines[float(value)] = {
+            'points': points,
+            'normals': points / np.linalg.norm(points, axis=-1, keepdims=True),
+            'offsets': np.arange(0, len(points) + 1, 2, dtype=np.int64),
+            'connectivity': np.arange(len(points), dtype=np.int64),
+        }
+
+    return isolines
+
+
+def ensureIsolines(datasetPath, values, data=None, workers=None):
+    '''
+    Return the isolines of a dataset at the given heights, as a dict from
+    each height to its isoline arrays (see contourLevel).
+
+    If the config of the celestial body is given and its topographic map is
+    available, isolines are traced on the map (see gridIsolines), otherwise
+    the dataset is contoured in parallel. Levels are read from the isoline
+    cache; those that are missing, or all of them if the dataset is newer
+    than the cache or they were made the other way, are computed and saved
+    to it.
+    '''
+    useGrid = (
+        data is not None and
+        os.path.exists(os.path.join('images', data.topo))
+    )
+    engine = 'grid' if useGrid else 'mesh'
+
+    path = isolinesPath(datasetPath)
+    cached = {}
+    if (os.path.exists(path) and
+            os.path.getmtime(path) >= os.path.getmtime(datasetPath)):
+        with np.load(path) as f:
+            if 'engine' in f and str(f['engine']) == engine:
+                for value in f['values']:
+                    cached[float(value)] = {
+                        key: f[f'{key}_{value:g}'] for key in ISOLINE_KEYS
+                    }
+
+    missing = [v for v in values if float(v) not in cached]
+    if missing and useGrid:
+        cached.update(gridIsolines(data, missing))
+        saveIsolines(path, cached, engine)
+    elif missing:
+        # Forked workers do not re-run the calling script, which the
+        # visualisation scripts need as they have no __main__ guard.
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = None
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_initWorker, initargs=(datasetPath,)
+        ) as pool:
+            isolines = pool.map(contourLevel, missing)
+            for value, isoline in zip(missing, isolines):
+                cached[float(value)] = isoline
+        saveIsolines(path, cached, engine)
+
+    return {float(v): cached[float(v)] for v in values}
+
+
+def saveIsolines(path, isolines, engine):
+    '''Write isolines, as returned by ensureIsolines, to the cache file.'''
+    arrays = {'values': np.array(sorted(isolines)), 'engine': engine}
+    for value, isoline in isolines.items():
+        for key, array in isoline.items():
+            arrays[f'{key}_{value:g}'] = array
+
+    # Viewers of the same dataset may save their isolines at the same time
+    tmpPath = f'{path}.{os.getpid()}.tmp'
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmpPath, path)
+
+
+def isolinesToPolyData(isolines, name='Heights'):
+    '''
+    Combine isolines into a single VTK polydata, with each point's height
+    stored as its scalar value.
+    '''
+    pointCounts = [len(isoline['points']) for isoline in isolines.values()]
+    pointOffsets = np.cumsum([0] + pointCounts[:-1])
+
+    points = np.concatenate(
+        [isoline['points'] for isoline in isolines.values()]
+    )
+    normals = np.concatenate(
+        [isoline['normals'] for isoline in isolines.values()]
+    )
+    heights = np.repeat(list(isolines), pointCounts).astype(np.float64)
+
+    connectivity = np.concatenate([
+        isoline['connectivity'] + start
+        for isoline, start in zip(isolines.values(), pointOffsets)
+    ]).astype(np.int64)
+    cellCounts = np.concatenate(
+        [np.diff(isoline['offsets']) for isoline in isolines.values()]
+    )
+    offsets = np.concatenate(([0], np.cumsum(cellCounts))).astype(np.int64)
+
+    lines = vtk.vtkCellArray()
+    lines.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True)
+    )
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk.vtkPoints())
+    polydata.GetPoints().SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    polydata.SetLines(lines)
+
+    vtkNormals = numpy_support.numpy_to_vtk(normals, deep=True)
+    vtkNormals.SetName('Normals')
+    polydata.GetPointData().SetNormals(vtkNormals)
+
+    vtkHeights = numpy_support.numpy_to_vtk(heights, deep=True)
+    vtkHeights.SetName(name)
+    polydata.GetPointData().SetScalars(vtkHeights)
+
+    return polydata
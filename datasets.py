@@ -0,0 +1,329 @@
+'''
+Reading, naming and caching of the VTK datasets built for celestial bodies.
+
+Datasets are written in one of three formats, chosen by the extension of
+`vtksource`:
+
+    .vtp    VTK XML polydata
+    .npz    a compact format that only stores the heights of the sphere
+            vertices, quantized to 16 bits and compressed, along with the
+            parameters the sphere was generated with; the sphere itself is
+            regenerated when the dataset is read
+    .mmap   a directory of raw NumPy arrays, which are memory-mapped and
+            wrapped as VTK arrays without copying or decoding them, so
+            viewers opening the same dataset share them through the page
+            cache
+
+Each dataset is written as a pyramid of levels of detail: level 0 is the
+dataset itself, and each following level is built with half the sphere
+resolution of the one before it.
+
+Datasets built by readCylindricalTopo.py are kept in a build cache
+(`sources/cache/`), named by a hash of the config parameters and the
+topographic map they were built from. A config whose inputs have not changed
+therefore always finds its dataset, and a changed config never picks up a
+stale one.
+'''
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+import utils
+
+CACHE_DIR = 'sources/cache'
+
+# Bump whenever a change to the build pipeline changes the datasets it makes,
+# so that datasets built by older versions are not reused.
+BUILD_VERSION = 4
+
+# Config parameters that the built dataset depends on
+BUILD_FIELDS = (
+    'hMin', 'hMax', 'R', 'sfR', 'sf', 'topo', 'res', 'sampling',
+    'topoWidth', 'topoHeight', 'topoDtype', 'lods', 'mesh'
+)
+
+
+def lodPath(path, level):
+    '''Return the filename of the given level of detail of a dataset.'''
+    if level == 0:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f'{stem}_lod{level}{ext}'
+
+
+def readDataset(path):
+    '''Read a dataset from a file as VTK polydata.'''
+    if path.endswith('.mmap'):
+        return readMmapDataset(path)
+
+    if path.endswith('.npz'):
+        return readCompactDataset(path)
+
+    polyReader = vtk.vtkXMLPolyDataReader()
+    polyReader.SetFileName(path)
+    polyReader.Update()
+    return polyReader.GetOutput()
+
+
+def writeDataset(polydata, path, radius, res, mesh='uv'):
+    '''
+    Write a sphere dataset, generated by utils.makeSphere with the given
+    radius, resolution and mesh, to a file in the format given by its
+    extension.
+
+    The files are written under temporary names of their own process and
+    then renamed, so that a dataset is never seen half written, even when
+    several processes build it at once.
+    '''
+    if path.endswith('.mmap'):
+        writeMmapDataset(polydata, path)
+        return
+
+    tmpPath = f'{path}.{os.getpid()}.tmp'
+    if path.endswith('.npz'):
+        with open(tmpPath, 'wb') as f:
+            writeCompactDataset(polydata, f, radius, res, mesh)
+    else:
+        vtkWriter = vtk.vtkXMLPolyDataWriter()
+        vtkWriter.SetFileName(tmpPath)
+        vtkWriter.SetInputData(polydata)
+        vtkWriter.Write()
+
+    os.replace(tmpPath, path)
+
+
+def writeMmapDataset(polydata, directory):
+    '''
+    Write the points, polygons and point data arrays of a dataset as raw
+    NumPy arrays in a directory.
+
+    If the directory already exists, it is kept as it is: datasets in the
+    build cache are named by their inputs, so it holds the same dataset.
+    '''
+    pointData = polydata.GetPointData()
+    polys = polydata.GetPolys()
+    arrays = {
+        'points': polydata.GetPoints().GetData(),
+        'offsets': polys.GetOffsetsArray(),
+        'connectivity': polys.GetConnectivityArray(),
+    }
+    roles = {
+        role: getattr(pointData, f'Get{role}')()
+        for role in ('Scalars', 'Normals', 'TCoords', 'Vectors')
+    }
+
+    layout = {'pointData': []}
+    for i in range(pointData.GetNumberOfArrays()):
+        array = pointData.GetArray(i)
+        role = next((r for r, a in roles.items() if a is array), None)
+        layout['pointData'].append([array.GetName(), role])
+        arrays[f'point_{array.GetName()}'] = array
+
+    tmpDirectory = f'{directory}.{os.getpid()}.tmp'
+    shutil.rmtree(tmpDirectory, ignore_errors=True)
+    os.makedirs(tmpDirectory)
+    for name, array in arrays.items():
+        values = numpy_support.vtk_to_numpy(array)
+        if name in ('offsets', 'connectivity'):
+            values = values.astype(np.int64, copy=False)
+        np.save(os.path.join(tmpDirectory, f'{name}.npy'), values)
+    with open(os.path.join(tmpDirectory, 'layout.json'), 'w') as f:
+        json.dump(layout, f)
+
+    try:
+        os.replace(tmpDirectory, directory)
+    except OSError:
+        # Another process has finished writing the dataset first. It is not
+        # replaced, as viewers may already have its arrays mapped
+        if not os.path.isdir(directory):
+            raise
+        shutil.rmtree(tmpDirectory)
+
+
+def readMmapDataset(directory):
+    '''
+    Read a dataset written by writeMmapDataset as VTK polydata whose arrays
+    are backed directly by the memory-mapped files.
+
+    The files are mapped copy-on-write, so pipelines that modify the
+    dataset's arrays in place never change the files.
+    '''
+    def load(name):
+        return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='c')
+
+    with open(os.path.join(directory, 'layout.json'), 'r') as f:
+        layout = json.load(f)
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(load('points'), deep=False))
+
+    polys = vtk.vtkCellArray()
+    polys.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(load('offsets'), deep=False),
+        numpy_support.numpy_to_vtkIdTypeArray(
+            load('connectivity'), deep=False
+        )
+    )
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+
+    pointData = polydata.GetPointData()
+    for name, role in layout['pointData']:
+        array = numpy_support.numpy_to_vtk(load(f'point_{name}'), deep=False)
+        array.SetName(name)
+        if role is None:
+            pointData.AddArray(array)
+        else:
+            getattr(pointData, f'Set{role}')(array)
+    return polydata
+
+
+def writeCompactDataset(polydata, file, radius, res, mesh='uv'):
+    '''
+    Write the heights of a sphere dataset, quantized to int16 with a scale
+    and offset, and the parameters needed to regenerate the sphere.
+    '''
+    heights = numpy_support.vtk_to_numpy(polydata.GetPointData().GetScalars())
+    hMin, hMax = float(np.min(heights)), float(np.max(heights))
+
+    offset = (hMax + hMin) / 2
+    scale = (hMax - hMin) / (2 * np.iinfo(np.int16).max) or 1.0
+    quantized = np.rint((heights - offset) / scale).astype(np.int16)
+
+    np.savez_compressed(
+        file, heights=quantized, scale=scale, offset=offset,
+        radius=radius, res=res, mesh=mesh
+    )
+
+
+def readCompactDataset(path):
+    '''
+    Read a compact dataset, regenerating its sphere and restoring the
+    heights as the point scalars, and its texture coordinates.
+
+    The heights are stored in the order of the points of the sphere that
+    makeSphere generates, so compact datasets written by older versions,
+    whose spheres were generated differently, cannot be read and must be
+    rebuilt.
+    '''
+    with np.load(path) as f:
+        if 'mesh' not in f:
+            raise ValueError(
+                f'{path}: was written by an older version, rebuild it'
+            )
+        sphere = utils.makeSphere(
+            float(f['radius']), int(f['res']), str(f['mesh'])
+        )
+        heights = f['heights'] * float(f['scale']) + float(f['offset'])
+
+    if len(heights) != sphere.GetNumberOfPoints():
+        raise ValueError(
+            f'{path}: has {len(heights)} heights but its sphere has '
+            f'{sphere.GetNumberOfPoints()} points; it was probably written '
+            'by an older version, rebuild it'
+        )
+
+    sphere.GetPointData().SetScalars(utils.heightsToVtkArray(heights))
+    points = numpy_support.vtk_to_numpy(sphere.GetPoints().GetData())
+    _, lmbdas, phis = utils.cartesianToGeo(*points.T)
+    triangles = numpy_support.vtk_to_numpy(
+        sphere.GetPolys().GetConnectivityArray()
+    )
+    sphere.GetPointData().SetTCoords(
+        utils.sphereTCoords(lmbdas, phis, triangles)
+    )
+    return sphere
+
+
+def readLevels(path):
+    '''
+    Read all levels of detail that exist for a dataset, finest first.
+
+    Datasets built without a pyramid just have the single level 0.
+    '''
+    levels = [readDataset(path)]
+    while os.path.exists(lodPath(path, len(levels))):
+        levels.append(readDataset(lodPath(path, len(levels))))
+    return levels
+
+
+def fileDigest(path, chunkSize=2**24):
+    '''
+    Return the SHA-256 digest of a file's contents.
+
+    Digests are remembered in the cache directory against the file's size
+    and modification time, so large topographic maps are only hashed again
+    when they change. Each file's digest is kept in a memo file of its own,
+    named by a hash of the file's absolute path, so that builds and viewers
+    running at the same time never overwrite each other's digests.
+    '''
+    stat = os.stat(path)
+    pathKey = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    memoPath = os.path.join(CACHE_DIR, 'digests', f'{pathKey[:32]}.json')
+    try:
+        with open(memoPath, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        entry = None
+
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    os.makedirs(os.path.dirname(memoPath), exist_ok=True)
+    with open(f'{memoPath}.{os.getpid()}', 'w') as f:
+        json.dump([stat.st_size, stat.st_mtime_ns, digest], f)
+    os.replace(f'{memoPath}.{os.getpid()}', memoPath)
+
+    return digest
+
+
+def datasetKey(data, directory='images'):
+    '''
+    Hash the config parameters and topographic map that a celestial body's
+    dataset is built from.
+    '''
+    fields = {field: getattr(data, field) for field in BUILD_FIELDS}
+    fields['version'] = BUILD_VERSION
+    fields['topoDigest'] = fileDigest(os.path.join(directory, data.topo))
+
+    return hashlib.sha256(
+        json.dumps(fields, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def cachedDatasetPath(data):
+    '''Return the build cache filename of a celestial body's dataset.'''
+    stem, ext = os.path.splitext(data.vtksource)
+    return os.path.join(CACHE_DIR, f'{stem}-{datasetKey(data)[:16]}{ext}')
+
+
+def ensureDataset(data, directory='images'):
+    '''
+    Return the filename of an up to date dataset for a celestial body,
+    building it first if it is missing from the build cache.
+
+    If the topographic map is not available, the pre-made dataset in
+    sources/ named by `vtksource` is used as it is.
+    '''
+    if not os.path.exists(os.path.join(directory, data.topo)):
+        return f'sources/{data.vtksource}'
+
+    path = cachedDatasetPath(data)
+    if not os.path.exists(path):
+        import readCylindricalTopo
+        print(f'Building {path}, this may take a few minutes...')
+        readCylindricalTopo.buildDataset(data, path)
+
+    return path
@@ -0,0 +1,180 @@
+'''
+Custom VTK filters used by the visualisation scripts.
+'''
+from collections import OrderedDict
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+from vtkmodules.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+
+class IncrementalWarpScalar(VTKPythonAlgorithmBase):
+    '''
+    Warp polydata along its point normals by its point scalars, like
+    vtkWarpScalar. The input must have point normals.
+
+    The base positions and the normals multiplied by the scalars are kept
+    for each input the filter sees, so changing the scale factor just
+    recomputes the warped points in place with one multiply-add and marks
+    them as modified, instead of re-executing the filter.
+    '''
+    def __init__(self, scaleFactor=1, cacheSize=8):
+        VTKPythonAlgorithmBase.__init__(
+            self, nInputPorts=1, inputType='vtkPolyData',
+            nOutputPorts=1, outputType='vtkPolyData'
+        )
+        self.scaleFactor = scaleFactor
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.current = None
+
+    def GetScaleFactor(self):
+        return self.scaleFactor
+
+    def SetScaleFactor(self, value):
+        self.scaleFactor = value
+        if self.current is not None:
+            self.warp(self.current)
+
+    def warp(self, entry):
+        if entry['scaleFactor'] != self.scaleFactor:
+            np.multiply(
+                entry['direction'], self.scaleFactor, out=entry['warped']
+            )
+            entry['warped'] += entry['base']
+            entry['scaleFactor'] = self.scaleFactor
+            entry['points'].Modified()
+
+    def cached(self, polydata):
+        '''Return the cached arrays for an input, creating them if needed.'''
+        arrays = (
+            polydata.GetPoints().GetData(),
+            polydata.GetPointData().GetScalars(),
+            polydata.GetPointData().GetNormals(),
+        )
+        key = tuple((a.__this__, a.GetMTime()) for a in arrays)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        points, heights, normals = (
+            numpy_support.vtk_to_numpy(a) for a in arrays
+        )
+        warped = np.empty_like(points)
+        entry = {
+            'arrays': arrays,
+            'base': points,
+            'direction': (normals * heights[:, np.newaxis]).astype(
+                points.dtype
+            ),
+            'warped': warped,
+            'points': vtk.vtkPoints(),
+            'scaleFactor': None,
+        }
+        entry['points'].SetData(numpy_support.numpy_to_vtk(warped))
+
+        self.cache[key] = entry
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return entry
+
+    def RequestData(self, request, inInfo, outInfo):
+        polydata = vtk.vtkPolyData.GetData(inInfo[0])
+        output = vtk.vtkPolyData.GetData(outInfo)
+
+        entry = self.cached(polydata)
+        self.warp(entry)
+        self.current = entry
+
+        # As with vtkWarpScalar, the normals of the unwarped surface are not
+        # passed on, since they no longer match the warped one.
+        output.ShallowCopy(polydata)
+        output.SetPoints(entry['points'])
+        output.GetPointData().SetNormals(None)
+        return 1
+
+
+class ScalableTubeFilter(VTKPythonAlgorithmBase):
+    '''
+    Turn lines into tubes, like vtkTubeFilter, with a radius that can be
+    changed cheaply.
+
+    The tube mesh is generated once per input, and every tube point is kept
+    as its line point plus an offset per unit of radius. Changing the radius
+    then rescales the offsets into the output points in place and marks them
+    as modified, so the tubes are never regenerated.
+    '''
+    def __init__(self, radius=1, numberOfSides=6):
+        VTKPythonAlgorithmBase.__init__(
+            self, nInputPorts=1, inputType='vtkPolyData',
+            nOutputPorts=1, outputType='vtkPolyData'
+        )
+        self.radius = radius
+        self.numberOfSides = numberOfSides
+        self.key = None
+        self.tubes = None
+        self.current = None
+
+    def GetRadius(self):
+        return self.radius
+
+    def SetRadius(self, value):
+        self.radius = value
+        if self.current is not None:
+            self.scale(self.current)
+
+    def GetNumberOfSides(self):
+        return self.numberOfSides
+
+    def SetNumberOfSides(self, value):
+        if value != self.numberOfSides:
+            self.numberOfSides = value
+            self.Modified()
+
+    def scale(self, entry):
+        if entry['radius'] != self.radius:
+            np.multiply(entry['direction'], self.radius, out=entry['scaled'])
+            entry['scaled'] += entry['base']
+            entry['radius'] = self.radius
+            entry['points'].Modified()
+
+    def tube(self, polydata, radius):
+        tubeFilter = vtk.vtkTubeFilter()
+        tubeFilter.SetInputData(polydata)
+        tubeFilter.SetNumberOfSides(self.numberOfSides)
+        tubeFilter.SetRadius(radius)
+        tubeFilter.Update()
+        return tubeFilter.GetOutput()
+
+    def RequestData(self, request, inInfo, outInfo):
+        polydata = vtk.vtkPolyData.GetData(inInfo[0])
+        output = vtk.vtkPolyData.GetData(outInfo)
+
+        key = (polydata.__this__, polydata.GetMTime(), self.numberOfSides)
+        if key != self.key:
+            # Tubes of radius 1 and 2 have the same topology, and their
+            # points differ by exactly the offset for a unit radius
+            unitTubes = self.tube(polydata, 1)
+            unitPoints = numpy_support.vtk_to_numpy(
+                unitTubes.GetPoints().GetData()
+            )
+            direction = numpy_support.vtk_to_numpy(
+                self.tube(polydata, 2).GetPoints().GetData()
+            ) - unitPoints
+            scaled = np.empty_like(unitPoints)
+            self.current = {
+                'base': unitPoints - direction,
+                'direction': direction,
+                'scaled': scaled,
+                'points': vtk.vtkPoints(),
+                'radius': None,
+            }
+            self.current['points'].SetData(numpy_support.numpy_to_vtk(scaled))
+            self.tubes = unitTubes
+            self.key = key
+
+        self.scale(self.current)
+
+        output.ShallowCopy(self.tubes)
+        output.SetPoints(self.current['points'])
+        return 1
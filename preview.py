@@ -0,0 +1,141 @@
+'''
+Previews of the heights computed by the build scripts.
+
+A build can end with one of these previews, chosen with `--preview MODE`:
+
+    none        no preview, for unattended builds
+    hillshade   a hillshaded, colour-mapped equirectangular image of the
+                heights, written to a PNG file next to the dataset (default)
+    scatter     an interactive 3D scatter plot of at most
+                `--preview-points N` of the height samples, with matplotlib
+
+Only the scatter plot needs matplotlib, which is imported only when it is
+shown. The hillshade image is downsampled before it is shaded, so it takes
+a fraction of a second whatever the size of the topographic map.
+'''
+import numpy as np
+
+PREVIEW_MODES = ('none', 'hillshade', 'scatter')
+
+# Maximum number of samples shown on the scatter plot
+DEFAULT_POINT_BUDGET = 100_000
+
+# Width of the hillshade image in pixels
+HILLSHADE_WIDTH = 2048
+
+
+def addPreviewArguments(parser, default='hillshade'):
+    '''
+    Add the `--preview MODE` and `--preview-points N` arguments to an
+    argparse parser.
+    '''
+    parser.add_argument(
+        '--preview', choices=PREVIEW_MODES, default=default,
+        help='how to preview the heights once the build is done '
+             f'(default: {default})'
+    )
+    parser.add_argument(
+        '--preview-points', type=int, default=DEFAULT_POINT_BUDGET,
+        dest='previewPoints', metavar='N',
+        help='maximum number of samples on the scatter preview'
+    )
+
+
+def previewPath(datasetPath):
+    '''Return the filename of the hillshade preview of a dataset.'''
+    return f'{datasetPath}.preview.png'
+
+
+def downsampleGrid(grid, width=HILLSHADE_WIDTH):
+    '''
+    Downsample a longitude/latitude grid by area averaging to at most the
+    given width, keeping its aspect ratio.
+    '''
+    import cv2
+    height = grid.shape[0] * width // grid.shape[1]
+    if grid.shape[1] <= width or height == 0:
+        return np.asarray(grid, dtype=np.float32)
+    return cv2.resize(
+        np.asarray(grid, dtype=np.float32), (width, height),
+        interpolation=cv2.INTER_AREA
+    )
+
+
+def hillshade(heights, radius, azimuth=315, altitude=45, exaggeration=10):
+    '''
+    Return the shading, from 0 to 1, of a grid of heights in metres laid out
+    as in readCylindricalTopo.py (first row at latitude -90, first column at
+    longitude -180) and lit from the given azimuth and altitude in degrees,
+    with the rows flipped so that north is at the top.
+
+    The relief is exaggerated, as in the viewers, so that it is visible at
+    the scale of a whole planet.
+    '''
+    heights = np.asarray(heights, dtype=np.float32)[::-1]
+    rows, cols = heights.shape
+
+    # Distances between samples in metres: rows are evenly spaced, while
+    # columns get closer towards the poles
+    lats = np.radians(np.linspace(90, -90, rows))
+    dy = np.pi * radius / max(rows - 1, 1)
+    dx = 2 * np.pi * radius * np.maximum(np.cos(lats), 1e-3) / max(cols - 1, 1)
+
+    # Image coordinates: x to the east, y to the south
+    dzdy, dzdx = np.gradient(heights * exaggeration)
+    dzdx /= dx[:, np.newaxis]
+    dzdy /= dy
+
+    slope = np.arctan(np.hypot(dzdx, dzdy))
+    aspect = np.arctan2(dzdy, -dzdx)
+    sunAzimuth = np.radians(90 - azimuth)
+    sunAltitude = np.radians(altitude)
+
+    shade = (
+        np.sin(sunAltitude) * np.cos(slope)
+        + np.cos(sunAltitude) * np.sin(slope) * np.cos(sunAzimuth - aspect)
+    )
+    return np.clip(shade, 0, 1)
+
+
+def saveHillshade(path, heights, radius):
+    '''
+    Write a grid of heights in metres (see hillshade) to a PNG file as a
+    colour map of the heights, shaded by the relief.
+    '''
+    import cv2
+    heights = downsampleGrid(heights)
+    shade = hillshade(heights, radius)
+
+    hMin, hMax = np.min(heights), np.max(heights)
+    levels = (heights[::-1] - hMin) * (255 / ((hMax - hMin) or 1))
+    colours = cv2.applyColorMap(levels.astype(np.uint8), cv2.COLORMAP_TURBO)
+
+    image = colours * (0.35 + 0.65 * shade[..., np.newaxis])
+    if not cv2.imwrite(path, image.astype(np.uint8)):
+        raise OSError(f'Could not write {path}')
+    return path
+
+
+def decimate(n, budget, seed=0):
+    '''
+    Return the sorted indices of a random subset of at most `budget` of n
+    samples.
+    '''
+    if n <= budget:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n, budget, replace=False))
+
+
+def showScatter(xs, ys, zs, **scatterArgs):
+    '''Show points on an interactive matplotlib 3D scatter plot.'''
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=[10, 10])
+    ax = fig.add_subplot(projection='3d')
+
+    ax.scatter(xs, ys, zs, s=1, **scatterArgs)
+
+    ax.set_box_aspect((2, 2, 2))
+    ax.set(xlabel='x', ylabel='y', zlabel='z')
+    plt.show()
@@ -0,0 +1,418 @@
+'''
+Optional profiling for the dataset build scripts and the viewers.
+
+A StageProfiler splits a run into named stages and records, for each one,
+its wall time, the resident memory of the process at its end, the peak
+resident memory of the process so far, the peak memory traced by
+tracemalloc during the stage (which includes NumPy arrays), and where the
+largest allocations still alive at its end were made. The report can be
+saved as JSON and printed as a summary table.
+
+A FrameProfiler records, for every frame a viewer renders, its render time,
+the time spent updating each of the observed filters of the pipeline, and
+the number of triangles drawn, as well as the latency from slider changes
+to the end of the frame showing them. It can show these in an overlay while
+the viewer runs, and saves them as JSON when it is closed.
+
+A disabled profiler records nothing, so the scripts can always call it and
+only pay for profiling when it is asked for.
+'''
+from collections import deque
+from contextlib import contextmanager
+import json
+import numpy as np
+import os
+import sys
+import time
+import tracemalloc
+import vtk
+from vtk.util import numpy_support
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def currentRss():
+    '''Return the resident memory of this process in bytes, if known.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peakRss():
+    '''Return the peak resident memory of this process in bytes, if known.'''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def addProfileArgument(parser, help):
+    '''Add a `--profile [REPORT]` argument to an argparse parser.'''
+    parser.add_argument(
+        '--profile', nargs='?', const='', metavar='REPORT', help=help
+    )
+
+
+def reportPath(args, default):
+    '''
+    Return the report path given with the `--profile [REPORT]` argument of
+    parsed command line arguments, the default path if no report is named,
+    or None if profiling was not asked for.
+    '''
+    if args.profile is None:
+        return None
+    return args.profile or default
+
+
+def allocationSite(traceback):
+    '''
+    Return the innermost frame of an allocation traceback that is in this
+    repository, so that allocations made inside NumPy or VTK are attributed
+    to the line of the build script that asked for them.
+    '''
+    for frame in reversed(traceback):
+        if frame.filename.startswith(REPO_DIR):
+            filename = os.path.relpath(frame.filename, REPO_DIR)
+            return f'{filename}:{frame.lineno}'
+    frame = traceback[-1]
+    return f'{frame.filename}:{frame.lineno}'
+
+
+class StageProfiler:
+    '''
+    Record the time and memory use of the named stages of a run.
+
+    Stages are either delimited with start() and stop(), where starting a
+    stage stops the current one, which suits flat scripts, or with the
+    stage() context manager.
+    '''
+    def __init__(self, enabled=True, topAllocations=5, traceFrames=8):
+        self.enabled = enabled
+        self.topAllocations = topAllocations
+        self.traceFrames = traceFrames
+        self.stages = []
+        self.current = None
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceFrames)
+
+        self.current = {
+            'name': name,
+            'snapshot': self.snapshot(),
+            'startPeakRss': peakRss(),
+        }
+        tracemalloc.reset_peak()
+        self.current['startTraced'] = tracemalloc.get_traced_memory()[0]
+        self.current['start'] = time.perf_counter()
+
+    def stop(self):
+        if not self.enabled or self.current is None:
+            return
+        seconds = time.perf_counter() - self.current['start']
+        tracedPeak = (
+            tracemalloc.get_traced_memory()[1] - self.current['startTraced']
+        )
+
+        sites = {}
+        snapshot = self.snapshot()
+        for stat in snapshot.compare_to(self.current['snapshot'], 'traceback'):
+            if stat.size_diff > 0:
+                site = allocationSite(stat.traceback)
+                sites[site] = sites.get(site, 0) + stat.size_diff
+        largest = sorted(sites.items(), key=lambda s: s[1], reverse=True)
+
+        endPeakRss = peakRss()
+        self.stages.append({
+            'name': self.current['name'],
+            'seconds': seconds,
+            'rssBytes': currentRss(),
+            'peakRssBytes': endPeakRss,
+            'setsPeakRss': (
+                endPeakRss is not None and
+                endPeakRss > self.current['startPeakRss']
+            ),
+            'tracedPeakBytes': tracedPeak,
+            'largestAllocations': [
+                {'site': site, 'bytes': size}
+                for site, size in largest[:self.topAllocations]
+            ],
+        })
+        self.current = None
+
+    def snapshot(self):
+        '''Take a tracemalloc snapshot without the profiler's own memory.'''
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__, all_frames=True),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def report(self):
+        '''Return the report of all stages run so far as a dict.'''
+        self.stop()
+        return {
+            'argv': sys.argv,
+            'totalSeconds': sum(stage['seconds'] for stage in self.stages),
+            'peakRssBytes': peakRss(),
+            'stages': self.stages,
+        }
+
+    def save(self, path):
+        '''Write the report to a JSON file and print its summary.'''
+        if not self.enabled:
+            return
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(summary(report))
+        print(f'Saved profile {path}')
+
+
+def summary(report):
+    '''Return a human readable table of a profiling report.'''
+    def mib(size):
+        return f'{size / 2**20:10.1f}' if size is not None else f'{"-":>10}'
+
+    lines = [
+        f'{"stage":<24} {"time (s)":>9} {"RSS (MiB)":>10} '
+        f'{"peak RSS":>10} {"traced peak":>11}  largest allocation'
+    ]
+    for stage in report['stages']:
+        largest = stage['largestAllocations']
+        site = (
+            f'{largest[0]["site"]} ({largest[0]["bytes"] / 2**20:.1f} MiB)'
+            if largest else ''
+        )
+        lines.append(
+            f'{stage["name"]:<24} {stage["seconds"]:9.2f} '
+            f'{mib(stage["rssBytes"])} {mib(stage["peakRssBytes"])}'
+            f'{"*" if stage["setsPeakRss"] else " "}'
+            f'{mib(stage["tracedPeakBytes"])}  {site}'
+        )
+    lines.append(
+        f'{"total":<24} {report["totalSeconds"]:9.2f} {"":>10} '
+        f'{mib(report["peakRssBytes"])}'
+    )
+    lines.append('* the peak RSS of the build grew during this stage')
+    return '\n'.join(lines)
+
+
+def countTriangles(polydata):
+    '''Return the number of triangles in the polygons and strips of data.'''
+    triangles = 0
+    for cells in (polydata.GetPolys(), polydata.GetStrips()):
+        offsets = numpy_support.vtk_to_numpy(cells.GetOffsetsArray())
+        if len(offsets) > 1:
+            triangles += int(np.sum(np.diff(offsets) - 2))
+    return triangles
+
+
+class FrameProfiler:
+    '''
+    Record the render time, filter update times and triangle count of every
+    frame rendered by a renderer, and the latency of slider changes.
+
+    Filters to time are added with observeFilter() and sliders with
+    observeSlider(). Filters are usually updated by their mappers while a
+    frame is rendered, so their times are part of the frame's render time.
+    '''
+    def __init__(self, enabled=True, overlay=True, window=30):
+        self.enabled = enabled
+        self.overlay = overlay
+        self.frames = []
+        self.sliderLatencies = []
+        self.recent = deque(maxlen=window)
+        self.filterTimes = {}
+        self.filterStarts = {}
+        self.pendingSliders = {}
+        self.triangleCache = {}
+        self.frameStart = None
+        self.renderer = None
+        self.textActor = vtk.vtkTextActor() if enabled else None
+
+    def observe(self, renderer):
+        '''Record the frames rendered by a renderer, and show the overlay.'''
+        if not self.enabled:
+            return
+        self.renderer = renderer
+        renderer.AddObserver(vtk.vtkCommand.StartEvent, self.onFrameStart)
+        renderer.AddObserver(vtk.vtkCommand.EndEvent, self.onFrameEnd)
+
+        if self.overlay:
+            # Placed just below the title of the viewers
+            textProperty = self.textActor.GetTextProperty()
+            textProperty.SetVerticalJustificationToTop()
+            textProperty.SetFontSize(16)
+            coord = self.textActor.GetPositionCoordinate()
+            coord.SetCoordinateSystemToNormalizedDisplay()
+            coord.SetValue(0.05, 0.88)
+            renderer.AddActor(self.textActor)
+
+    def observeScene(self, scene):
+        '''Record the frames, filters and sliders of a utils.Scene.'''
+        self.observe(scene.renderer)
+        for name, algorithm in scene.filters.items():
+            self.observeFilter(name, algorithm)
+        for name, slider in scene.sliders.items():
+            self.observeSlider(name, slider)
+
+    def observeFilter(self, name, algorithm):
+        '''Record the time spent updating a filter in each frame.'''
+        if not self.enabled:
+            return
+        algorithm.AddObserver(
+            vtk.vtkCommand.StartEvent,
+            lambda caller, ev: self.filterStarts.__setitem__(
+                name, time.perf_counter()
+            )
+        )
+        algorithm.AddObserver(
+            vtk.vtkCommand.EndEvent,
+            lambda caller, ev: self.onFilterEnd(name)
+        )
+
+    def observeSlider(self, name, slider):
+        '''
+        Record the latency from a slider change to the end of the frame that
+        shows it.
+        '''
+        if not self.enabled:
+            return
+        # A high priority makes sure the change is timed from before the
+        # slider's own callbacks run
+        slider.AddObserver(
+            vtk.vtkCommand.InteractionEvent,
+            lambda caller, ev: self.pendingSliders.setdefault(
+                name, time.perf_counter()
+            ),
+            1.0
+        )
+
+    def onFilterEnd(self, name):
+        start = self.filterStarts.pop(name, None)
+        if start is not None:
+            self.filterTimes[name] = (
+                self.filterTimes.get(name, 0) + time.perf_counter() - start
+            )
+
+    def onFrameStart(self, caller, ev):
+        self.frameStart = time.perf_counter()
+
+    def onFrameEnd(self, caller, ev):
+        if self.frameStart is None:
+            return
+        end = time.perf_counter()
+        seconds = end - self.frameStart
+        self.frameStart = None
+
+        triangles = self.countVisibleTriangles()
+        self.frames.append({
+            'time': end,
+            'renderSeconds': seconds,
+            'filterSeconds': self.filterTimes,
+            'triangles': triangles,
+        })
+        self.filterTimes = {}
+        self.recent.append(seconds)
+
+        for name, start in self.pendingSliders.items():
+            self.sliderLatencies.append({
+                'slider': name, 'time': end, 'seconds': end - start
+            })
+        self.pendingSliders = {}
+
+        if self.overlay:
+            meanSeconds = sum(self.recent) / len(self.recent)
+            self.textActor.SetInput(
+                f'{1 / meanSeconds:.1f} fps ({meanSeconds * 1000:.1f} ms), '
+                f'{triangles / 1e6:.2f}M triangles'
+            )
+
+    def countVisibleTriangles(self):
+        '''
+        Return the number of triangles drawn by the visible actors of the
+        renderer. Counts are cached until the mapper inputs are modified.
+        '''
+        triangles = 0
+        actors = self.renderer.GetActors()
+        actors.InitTraversal()
+        for _ in range(actors.GetNumberOfItems()):
+            actor = actors.GetNextActor()
+            mapper = actor.GetMapper()
+            if not actor.GetVisibility() or mapper is None:
+                continue
+            polydata = mapper.GetInput()
+            if not isinstance(polydata, vtk.vtkPolyData):
+                continue
+            key = polydata.__this__
+            mtime = polydata.GetMTime()
+            if self.triangleCache.get(key, (None,))[0] != mtime:
+                self.triangleCache[key] = (mtime, countTriangles(polydata))
+            triangles += self.triangleCache[key][1]
+        return triangles
+
+    def report(self):
+        '''Return the recorded frames and a summary of them as a dict.'''
+        renderSeconds = np.array([f['renderSeconds'] for f in self.frames])
+        filterNames = sorted({
+            name for f in self.frames for name in f['filterSeconds']
+        })
+        summary = {
+            'frames': len(self.frames),
+            'filterSeconds': {
+                name: sum(f['filterSeconds'].get(name, 0)
+                          for f in self.frames)
+                for name in filterNames
+            },
+        }
+        if len(renderSeconds):
+            summary.update({
+                'meanRenderSeconds': float(renderSeconds.mean()),
+                'medianRenderSeconds': float(np.median(renderSeconds)),
+                'p95RenderSeconds': float(np.percentile(renderSeconds, 95)),
+                'maxTriangles': max(f['triangles'] for f in self.frames),
+            })
+        return {
+            'argv': sys.argv,
+            'summary': summary,
+            'frames': self.frames,
+            'sliderLatencies': self.sliderLatencies,
+        }
+
+    def save(self, path):
+        '''Write the frame log to a JSON file and print its summary.'''
+        if not self.enabled:
+            return
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        summary = report['summary']
+        if summary['frames']:
+            print(
+                f'{summary["frames"]} frames, render time mean '
+                f'{summary["meanRenderSeconds"] * 1000:.1f} ms, median '
+                f'{summary["medianRenderSeconds"] * 1000:.1f} ms, 95th '
+                f'percentile {summary["p95RenderSeconds"] * 1000:.1f} ms'
+            )
+        for name, seconds in summary['filterSeconds'].items():
+            print(f'  {name}: {seconds:.3f} s updating')
+        print(f'Saved frame log {path}')
@@ -1,9 +1,12 @@
+import argparse
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import spatial
-import vtk
+from vtk.util import numpy_support
 
+import datasets
+import preview
+import profiling
 import utils
 
 '''
@@ -25,9 +28,27 @@ westHemisphereX = np.array([13, 151])
 eastHemisphereX = np.array([2027, 151])
 hemisphereDims = np.array([1962, 1960])
 
+# Inverse scaling factor for the image. Matching colors to heights uses
+# bounded memory, so this can be set to 1 to use the full resolution image.
 sf = 6
 
+parser = argparse.ArgumentParser(
+    description='Create the sphere dataset for the original assignment.'
+)
+profiling.addProfileArgument(
+    parser, help='record the time and memory use of each build stage, and '
+                 'save them to REPORT (default: marstopo.vtp.profile.json)'
+)
+preview.addPreviewArguments(parser)
+args = parser.parse_args()
+
+reportPath = profiling.reportPath(args, 'marstopo.vtp.profile.json')
+profiler = profiling.StageProfiler(enabled=reportPath is not None)
+
+profiler.start('image load')
 img = cv2.imread('data/elevationData.tif')
+
+profiler.start('resize')
 width = int(img.shape[1] / sf)
 height = int(img.shape[0] / sf)
 smallImg = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
@@ -36,6 +57,7 @@ smallImg = cv2.medianBlur(smallImg, 3)
 #
 # Construct colormap from image
 #
+profiler.start('colormap')
 rawCmap = img[
     cmapX[1] + cmapDims[1] // 2,
     cmapX[0]:cmapX[0] + cmapDims[0]
@@ -111,6 +133,7 @@ del smallImg
 # plt.show()
 
 
+profiler.start('coordinate generation')
 wxs, wys = utils.getOrthHemisphereXYCoords(westHemiSmall)
 exs, eys = utils.getOrthHemisphereXYCoords(eastHemiSmall)
 
@@ -135,6 +158,7 @@ del elmbdas
 del wphis
 del ephis
 
+profiler.start('color matching')
 csBgr = np.concatenate((wcs, ecs))
 csHsv = cv2.cvtColor(np.array([csBgr]), cv2.COLOR_BGR2HSV)[0]
 
@@ -161,42 +185,53 @@ boundaryAltitudes[
 altitudesHsv[boundary] = boundaryAltitudes
 
 # Create sphere dataset and save as VTP file
+profiler.start('KDTree build')
 heightCoords = np.array([xs, ys, zs]).T
 tree = spatial.KDTree(heightCoords)
 
-sphereSource = vtk.vtkSphereSource()
-sphereSource.SetRadius(R * sfR)
-sphereSource.SetStartTheta(1e-5)
-sphereSource.SetThetaResolution(800)
-sphereSource.SetPhiResolution(800)
-sphereSource.Update()
-
-sphereHeights = vtk.vtkDoubleArray()
-sphereHeights.SetName('Heights')
-numPoints = sphereSource.GetOutput().GetNumberOfPoints()
-sphereHeights.SetNumberOfTuples(numPoints)
-spherePointsArray = sphereSource.GetOutput().GetPoints().GetData()
-for i in range(numPoints):
-    point = spherePointsArray.GetTuple3(i)
-    heightIdx = tree.query([point])[-1][0]
-    sphereHeights.SetTuple1(i, altitudesHsv[heightIdx] * sfR)
-sphereSource.GetOutput().GetPointData().SetScalars(sphereHeights)
-
-vtkWriter = vtk.vtkXMLPolyDataWriter()
-vtkWriter.SetFileName('marstopo.vtp')
-vtkWriter.SetInputData(sphereSource.GetOutput())
-vtkWriter.Write()
-
-# Show heights that have been computed
-fig = plt.figure(figsize=[10, 10])
-ax = fig.add_subplot(projection='3d')
-
-heightMapHsv = (R + 10 * altitudesHsv) * sfR
-xs, ys, zs = utils.geoToCartesian(heightMapHsv, lmbdas, phis)
-
-ax.scatter(xs, ys, zs, s=1, c=cv2.cvtColor(
-    np.array([mappedCsHsv]), cv2.COLOR_HSV2RGB)[0]/255.0
+profiler.start('sampling')
+sphere = utils.makeSphere(R * sfR, 800)
+
+spherePoints = numpy_support.vtk_to_numpy(sphere.GetPoints().GetData())
+sphereHeights = utils.heightsToVtkArray(
+    utils.sampleNearestHeights(tree, spherePoints, altitudesHsv) * sfR
+)
+sphere.GetPointData().SetScalars(sphereHeights)
+_, sphereLmbdas, spherePhis = utils.cartesianToGeo(*spherePoints.T)
+triangles = numpy_support.vtk_to_numpy(
+    sphere.GetPolys().GetConnectivityArray()
 )
-ax.set_box_aspect((2, 2, 2))
-ax.set(xlabel='x', ylabel='y', zlabel='z')
-plt.show()
+sphere.GetPointData().SetTCoords(
+    utils.sphereTCoords(sphereLmbdas, spherePhis, triangles)
+)
+
+profiler.start('VTP write')
+datasets.writeDataset(sphere, 'marstopo.vtp', R * sfR, 800)
+
+# Preview heights that have been computed
+profiler.start('preview')
+if args.preview == 'hillshade':
+    # Sample the heights on a longitude/latitude grid, like a topographic map
+    gridLmbdas, gridPhis = np.meshgrid(
+        np.linspace(-180, 180, preview.HILLSHADE_WIDTH),
+        np.linspace(-90, 90, preview.HILLSHADE_WIDTH // 2)
+    )
+    gridPoints = np.column_stack(
+        utils.geoToCartesian(R * sfR, gridLmbdas.ravel(), gridPhis.ravel())
+    )
+    gridHeights = utils.sampleNearestHeights(tree, gridPoints, altitudesHsv)
+    previewFile = preview.saveHillshade(
+        preview.previewPath('marstopo.vtp'),
+        gridHeights.reshape(gridLmbdas.shape), R
+    )
+    print(f'Saved {previewFile}')
+
+elif args.preview == 'scatter':
+    idx = preview.decimate(len(altitudesHsv), args.previewPoints)
+    heightMapHsv = (R + 10 * altitudesHsv[idx]) * sfR
+    xs, ys, zs = utils.geoToCartesian(heightMapHsv, lmbdas[idx], phis[idx])
+    preview.showScatter(xs, ys, zs, c=cv2.cvtColor(
+        np.array([mappedCsHsv[idx]]), cv2.COLOR_HSV2RGB)[0]/255.0
+    )
+
+profiler.save(reportPath)
@@ -1,81 +1,135 @@
-import cv2
-import matplotlib.pyplot as plt
+import argparse
 import numpy as np
-from scipy import spatial
-import vtk
-import sys
+import os
+from vtk.util import numpy_support
 
+import datasets
+import preview
+import profiling
 import utils
 
-# Open and load config from file.
-dataFile = sys.argv[1]
-data = utils.readDataFile(dataFile)
-
-# Open and preprocess topographic map.
-og_img = cv2.imread(f'images/{data.topo}', 0)
-width = int(og_img.shape[1] / data.sf)
-height = int(og_img.shape[0] / data.sf)
-img = cv2.resize(og_img, (width, height), interpolation=cv2.INTER_AREA)
-img = cv2.flip(img, 0)
-
-del og_img
-
-# We need longitudes (lmbdas) and latitudes (phis) from the topographic map
-# to be able to convert them to 3D cartesian coordinates.
-
-# In our equirectangularly projected topographic map, x and y coords are
-# longitudes and latitudes respectively, so just need to scale them to
-# appropriate ranges.
-
-ycoords, xcoords = np.where(img >= 0)
-
-# Longitudes go from -180 to +180
-lmbdas = (xcoords * (360 / np.max(xcoords))) - 180
-# Latitudes go from -90 to +90
-phis = (ycoords * (180 / np.max(ycoords))) - 90
-
-# Get elevations from the topographic map
-img -= np.min(img)
-rs = img.reshape(-1) * ((data.hMax - data.hMin) / np.max(img))
-rs += data.hMin
-
-# Compute cartesian coordinates of planet surface points.
-xs, ys, zs = utils.geoToCartesian(data.R * data.sfR, lmbdas, phis)
-
-# Create sphere dataset and save as VTP file
-heightCoords = np.array([xs, ys, zs]).T
-sys.setrecursionlimit(10000)
-tree = spatial.KDTree(heightCoords)
-
-sphereSource = vtk.vtkSphereSource()
-sphereSource.SetRadius(data.R * data.sfR)
-sphereSource.SetStartTheta(1e-5)
-sphereSource.SetThetaResolution(int(data.res))
-sphereSource.SetPhiResolution(int(data.res))
-sphereSource.Update()
-
-sphereHeights = vtk.vtkDoubleArray()
-sphereHeights.SetName('Heights')
-numPoints = sphereSource.GetOutput().GetNumberOfPoints()
-sphereHeights.SetNumberOfTuples(numPoints)
-spherePointsArray = sphereSource.GetOutput().GetPoints().GetData()
-for i in range(numPoints):
-    point = spherePointsArray.GetTuple3(i)
-    heightIdx = tree.query([point])[-1][0]
-    sphereHeights.SetTuple1(i, rs[heightIdx] * data.sfR)
-sphereSource.GetOutput().GetPointData().SetScalars(sphereHeights)
-
-vtkWriter = vtk.vtkXMLPolyDataWriter()
-vtkWriter.SetFileName(f'sources/{data.vtksource}')
-vtkWriter.SetInputData(sphereSource.GetOutput())
-vtkWriter.Write()
-
-# Show heights that have been computed
-fig = plt.figure(figsize=[10, 10])
-ax = fig.add_subplot(projection='3d')
-
-ax.scatter(xs, ys, zs, s=1, c=img.reshape(-1)/255.0, cmap='binary_r')
-
-ax.set_box_aspect((2, 2, 2))
-ax.set(xlabel='x', ylabel='y', zlabel='z')
-plt.show()
+
+def buildDataset(data, path, img=None, imgRange=None, profiler=None):
+    '''
+    Create the sphere datasets for a celestial body, at every level of
+    detail, and save them as VTP files.
+
+    The topographic map is read from the config unless it has already been
+    read with utils.readTopoGrid and is passed in. The finest level is
+    written last, so its presence means that the whole pyramid is complete.
+    Stages are recorded by the given profiling.StageProfiler, if any.
+    '''
+    if profiler is None:
+        profiler = profiling.StageProfiler(enabled=False)
+
+    # In our equirectangularly projected topographic map, x and y coords are
+    # longitudes and latitudes respectively: columns go from -180 to +180 and
+    # rows from -90 to +90. Heights can therefore be looked up directly in
+    # the map from the longitude and latitude of each sphere point.
+    if img is None:
+        with profiler.stage('read topo map'):
+            img, imgRange = utils.readTopoGrid(data)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # Halve the sphere resolution for each level of detail
+    for level in reversed(range(int(data.lods))):
+        res = max(int(data.res) >> level, 8)
+        with profiler.stage(f'sample lod{level}'):
+            sphere = sampleHeights(data, img, imgRange, res)
+        with profiler.stage(f'write lod{level}'):
+            datasets.writeDataset(
+                sphere, datasets.lodPath(path, level), data.R * data.sfR, res,
+                data.mesh
+            )
+
+
+def sampleHeights(data, img, imgRange, res):
+    '''
+    Create a sphere of the given resolution for a celestial body, with the
+    heights sampled from its topographic map as point scalars, and its
+    texture coordinates.
+    '''
+    sphere = utils.makeSphere(data.R * data.sfR, res, data.mesh)
+
+    spherePoints = numpy_support.vtk_to_numpy(sphere.GetPoints().GetData())
+    _, sphereLmbdas, spherePhis = utils.cartesianToGeo(*spherePoints.T)
+    sphereHeights = utils.heightsToVtkArray(
+        utils.topoToHeights(
+            utils.sampleEquirectangular(
+                img, sphereLmbdas, spherePhis,
+                method=utils.SampleMethod[data.sampling.upper()]
+            ),
+            imgRange, data
+        ) * data.sfR
+    )
+    sphere.GetPointData().SetScalars(sphereHeights)
+    # Baked in here so the viewers need not run vtkTextureMapToSphere
+    triangles = numpy_support.vtk_to_numpy(
+        sphere.GetPolys().GetConnectivityArray()
+    )
+    sphere.GetPointData().SetTCoords(
+        utils.sphereTCoords(sphereLmbdas, spherePhis, triangles)
+    )
+    return sphere
+
+
+def showPreview(data, img, imgRange, path, mode='hillshade',
+                budget=preview.DEFAULT_POINT_BUDGET):
+    '''
+    Preview the heights of the topographic map of a dataset: as a hillshade
+    image written next to it, or on a 3D scatter plot of at most `budget`
+    of the map's samples. See preview.py.
+    '''
+    if mode == 'hillshade':
+        heights = utils.topoToHeights(
+            preview.downsampleGrid(img), imgRange, data
+        )
+        previewFile = preview.saveHillshade(
+            preview.previewPath(path), heights, data.R
+        )
+        print(f'Saved {previewFile}')
+
+    elif mode == 'scatter':
+        idx = preview.decimate(img.size, budget)
+        ycoords, xcoords = np.unravel_index(idx, img.shape)
+        lmbdas = xcoords * (360 / (img.shape[1] - 1)) - 180
+        phis = ycoords * (180 / (img.shape[0] - 1)) - 90
+        xs, ys, zs = utils.geoToCartesian(data.R * data.sfR, lmbdas, phis)
+        preview.showScatter(
+            xs, ys, zs, c=img.reshape(-1)[idx], cmap='binary_r'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the sphere datasets for a celestial body.'
+    )
+    parser.add_argument('config', help='config file of the celestial body')
+    profiling.addProfileArgument(
+        parser, help='record the time and memory use of each build stage, '
+                     'and save them to REPORT (default: next to the dataset)'
+    )
+    preview.addPreviewArguments(parser)
+    args = parser.parse_args()
+
+    # Open and load config from file.
+    data = utils.readDataFile(args.config)
+    path = datasets.cachedDatasetPath(data)
+    profiler = profiling.StageProfiler(enabled=args.profile is not None)
+
+    # Open and preprocess topographic map.
+    with profiler.stage('read topo map'):
+        img, imgRange = utils.readTopoGrid(data)
+
+    # Create sphere datasets in the build cache and preview the heights that
+    # have been computed
+    buildDataset(data, path, img, imgRange, profiler)
+    print(f'Saved {path}')
+
+    with profiler.stage('preview'):
+        showPreview(
+            data, img, imgRange, path, args.preview, args.previewPoints
+        )
+
+    profiler.save(profiling.reportPath(args, f'{path}.profile.json'))
@@ -0,0 +1,214 @@
+'''
+Offscreen render benchmark for the visualisation scripts.
+
+Each scene of visTopo.py, visTopoWithSea.py and visIsolines.py is created for
+a celestial body, rendered offscreen, and driven along a fixed camera path:
+an orbit and a zoom in and back out, run as interactions (so the coarser
+interactive levels of detail are used, as when dragging the mouse), followed
+by a sweep of each of the scene's sliders. The time of every frame is
+recorded, including the slider callbacks for slider sweeps, and the frame
+time percentiles of each phase of the path are written to a JSON file, which
+can be compared with one from another commit:
+
+    python renderBenchmark.py data/mars.dat results.json [--scenes ...]
+    python renderBenchmark.py --compare before.json after.json
+'''
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+import vtk
+
+import benchmark
+import utils
+import visIsolines
+import visTopo
+import visTopoWithSea
+
+SCENES = {
+    'topo': visTopo.createScene,
+    'sea': visTopoWithSea.createScene,
+    'isolines': visIsolines.createScene,
+}
+
+ORBIT_FRAMES = 36
+ZOOM_FRAMES = 20
+SLIDER_FRAMES = 20
+PERCENTILES = (50, 90, 95, 99)
+
+
+def timeFrame(renderWindow, change=None):
+    '''
+    Apply a change to the scene, if any, render it, and return the time
+    taken until the frame is complete.
+    '''
+    start = time.perf_counter()
+    if change is not None:
+        change()
+    renderWindow.Render()
+    renderWindow.WaitForCompletion()
+    return time.perf_counter() - start
+
+
+def interaction(scene, steps):
+    '''
+    Render one frame after each of the given camera changes, between the
+    start and end of an interaction, and return the frame times.
+    '''
+    style = scene.interactor.GetInteractorStyle()
+    style.InvokeEvent(vtk.vtkCommand.StartInteractionEvent)
+    times = [timeFrame(scene.renderWindow, step) for step in steps]
+    style.InvokeEvent(vtk.vtkCommand.EndInteractionEvent)
+    return times
+
+
+def sliderSweep(scene, slider):
+    '''
+    Move a slider from its minimum to its maximum value and back to where it
+    was, rendering a frame after each move, and return the frame times.
+    '''
+    rep = slider.GetRepresentation()
+    initial = rep.GetValue()
+    values = np.concatenate([
+        np.linspace(rep.GetMinimumValue(), rep.GetMaximumValue(),
+                    SLIDER_FRAMES),
+        [initial]
+    ])
+
+    def move(value):
+        rep.SetValue(value)
+        slider.InvokeEvent(vtk.vtkCommand.InteractionEvent)
+
+    times = [
+        timeFrame(scene.renderWindow, lambda v=v: move(v)) for v in values
+    ]
+    slider.InvokeEvent(vtk.vtkCommand.EndInteractionEvent)
+    return times
+
+
+def replay(scene):
+    '''
+    Drive a scene along the camera path, and return the frame times of each
+    of its phases by name.
+    '''
+    camera = scene.renderer.GetActiveCamera()
+    phases = {}
+
+    phases['orbit'] = interaction(
+        scene, [lambda: camera.Azimuth(360 / ORBIT_FRAMES)] * ORBIT_FRAMES
+    )
+    zoomFactor = 4 ** (1 / ZOOM_FRAMES)
+    phases['zoom'] = interaction(
+        scene,
+        [lambda: camera.Dolly(zoomFactor)] * ZOOM_FRAMES +
+        [lambda: camera.Dolly(1 / zoomFactor)] * ZOOM_FRAMES
+    )
+    # Still frames after the interaction, at the resting level of detail
+    phases['still'] = [timeFrame(scene.renderWindow) for _ in range(10)]
+
+    for name, slider in scene.sliders.items():
+        phases[f'slider: {name}'] = sliderSweep(scene, slider)
+
+    return phases
+
+
+def summarise(times):
+    times = np.array(times)
+    summary = {'frames': len(times), 'meanSeconds': float(times.mean())}
+    for p in PERCENTILES:
+        summary[f'p{p}Seconds'] = float(np.percentile(times, p))
+    summary['maxSeconds'] = float(times.max())
+    return summary
+
+
+def runScenes(data, sceneNames, size):
+    '''Benchmark the named scenes for a celestial body.'''
+    results = []
+    for sceneName in sceneNames:
+        start = time.perf_counter()
+        scene = SCENES[sceneName](data, offScreen=True)
+        scene.renderWindow.SetSize(*size)
+        scene.renderWindow.Render()
+        scene.renderWindow.WaitForCompletion()
+        setupSeconds = time.perf_counter() - start
+
+        results.append({
+            'scene': sceneName, 'phase': 'setup', 'frames': 1,
+            'meanSeconds': setupSeconds,
+        })
+        print(f'{sceneName:<10} {"setup":<28} {setupSeconds * 1000:10.1f} ms')
+
+        for phase, times in replay(scene).items():
+            summary = summarise(times)
+            results.append({'scene': sceneName, 'phase': phase, **summary})
+            print(
+                f'{sceneName:<10} {phase:<28} '
+                f'p50 {summary["p50Seconds"] * 1000:8.1f} ms  '
+                f'p95 {summary["p95Seconds"] * 1000:8.1f} ms  '
+                f'max {summary["maxSeconds"] * 1000:8.1f} ms'
+            )
+
+        scene.renderWindow.Finalize()
+    return results
+
+
+def compare(beforeFile, afterFile):
+    '''
+    Print the change in median and 95th percentile frame time of every
+    phase that was run in both of the given result files.
+    '''
+    with open(beforeFile) as f:
+        before = json.load(f)
+    with open(afterFile) as f:
+        after = json.load(f)
+
+    beforeResults = {(r['scene'], r['phase']): r for r in before['results']}
+    print(f'{before["commit"]} -> {after["commit"]}')
+    for result in after['results']:
+        old = beforeResults.get((result['scene'], result['phase']))
+        if old is None:
+            continue
+        ratios = [
+            f'{key[:-len("Seconds")]} x{result[key] / old[key]:6.2f}'
+            for key in ('meanSeconds', 'p50Seconds', 'p95Seconds')
+            if key in result and key in old
+        ]
+        print(f'{result["scene"]:<10} {result["phase"]:<28} '
+              + '  '.join(ratios))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', nargs='?',
+                        help='config file of the celestial body')
+    parser.add_argument('output', nargs='?', default='renderBenchmark.json',
+                        help='file to write the results to')
+    parser.add_argument('--scenes', nargs='+', choices=SCENES,
+                        default=list(SCENES), help='scenes to benchmark')
+    parser.add_argument('--size', nargs=2, type=int, default=[1280, 720],
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='size of the offscreen render window')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.config is None:
+        parser.error('a config file is needed to run the benchmark')
+    else:
+        data = utils.readDataFile(args.config)
+        results = runScenes(data, args.scenes, args.size)
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': benchmark.currentCommit(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'config': args.config,
+                'size': args.size,
+                'vtk': vtk.vtkVersion.GetVTKVersion(),
+                'machine': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+        print(f'Saved {args.output}')
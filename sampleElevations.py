@@ -0,0 +1,92 @@
+'''
+Sample the elevations of a celestial body at points listed in a CSV file.
+
+The rows of the input are streamed in chunks, and each chunk is sampled in
+one batch with utils.ElevationSampler, so millions of points take seconds.
+Every row is written back out with an extra column holding the elevation in
+metres at its longitude and latitude (in degrees):
+
+    python sampleElevations.py data/mars.dat sites.csv [-o out.csv]
+        [--method nearest|bilinear] [--source auto|topo|dataset]
+        [--lon-column lon] [--lat-column lat]
+
+Use - to read the points from standard input. The output is written to
+standard output unless -o is given.
+'''
+import argparse
+import csv
+import itertools
+import sys
+
+import numpy as np
+
+import utils
+
+CHUNK_ROWS = 2**18
+
+
+def sampleCsv(sampler, rows, writer, lonIndex, latIndex, method,
+              chunkRows=CHUNK_ROWS):
+    '''
+    Write every row of a CSV reader with the elevation at its coords
+    appended, sampling a chunk of rows at a time. Returns the row count.
+    '''
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunkRows))
+        if not chunk:
+            return count
+        lmbdas = np.array([row[lonIndex] for row in chunk], dtype=np.float64)
+        phis = np.array([row[latIndex] for row in chunk], dtype=np.float64)
+        heights = sampler.sample(lmbdas, phis, method)
+        writer.writerows(
+            row + [f'{height:.2f}'] for row, height in zip(chunk, heights)
+        )
+        count += len(chunk)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', help='config file of the celestial body')
+    parser.add_argument('points', help='CSV file of points, with a header '
+                                       'row, or - for standard input')
+    parser.add_argument('-o', '--output', help='CSV file to write')
+    parser.add_argument('--method', choices=('nearest', 'bilinear'),
+                        default='bilinear', help='how elevations are '
+                        'sampled (default: bilinear)')
+    parser.add_argument('--source', choices=('auto', 'topo', 'dataset'),
+                        default='auto', help='sample the topographic map or '
+                        'the built dataset (default: the map if available)')
+    parser.add_argument('--lon-column', default='lon', dest='lonColumn',
+                        help='name of the longitude column (default: lon)')
+    parser.add_argument('--lat-column', default='lat', dest='latColumn',
+                        help='name of the latitude column (default: lat)')
+    parser.add_argument('--elevation-column', default='elevation',
+                        dest='elevationColumn',
+                        help='name of the added column (default: elevation)')
+    args = parser.parse_args()
+
+    data = utils.readDataFile(args.config)
+    sampler = utils.ElevationSampler(data, args.source)
+    method = utils.SampleMethod[args.method.upper()]
+
+    inFile = sys.stdin if args.points == '-' else open(args.points, newline='')
+    outFile = (
+        open(args.output, 'w', newline='') if args.output else sys.stdout
+    )
+    with inFile, outFile:
+        rows = csv.reader(inFile)
+        header = next(rows)
+        for column in (args.lonColumn, args.latColumn):
+            if column not in header:
+                parser.error(f'{args.points} has no column {column!r}')
+
+        writer = csv.writer(outFile)
+        writer.writerow(header + [args.elevationColumn])
+        count = sampleCsv(
+            sampler, rows, writer, header.index(args.lonColumn),
+            header.index(args.latColumn), method
+        )
+
+    print(f'Sampled {count} points from the {sampler.source}',
+          file=sys.stderr)
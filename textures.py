@@ -0,0 +1,193 @@
+'''
+Caching of the textures of celestial bodies for the viewers.
+
+Decoding a large texture image and flipping it for texture mapping takes a
+large part of a viewer's startup, and the full image is often larger than
+the renderer can use. Each texture is therefore decoded once and stored in
+the texture cache (`sources/cache/textures/`) as a mip chain of
+uncompressed, memory-mappable NumPy arrays: level 0 has the largest
+power-of-two size that fits in the image, and each following level has half
+the width and height of the one before it. The arrays are stored with the
+rows in the order VTK expects for texture mapping, so they are handed to
+VTK as they are, without being decoded, flipped or copied.
+
+Like datasets, cached textures are named by a hash of the image they were
+made from, so a changed image is never shown from a stale cache.
+'''
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+import datasets
+
+TEXTURE_CACHE_DIR = os.path.join(datasets.CACHE_DIR, 'textures')
+
+# Bump whenever a change to how textures are cached changes the arrays
+TEXTURE_VERSION = 1
+
+# The mip chain stops once a level is no wider than this
+MIN_TEXTURE_WIDTH = 256
+
+# Assumed maximum texture size when the renderer cannot be asked for it
+DEFAULT_MAX_TEXTURE_SIZE = 8192
+
+
+def levelPath(directory, level):
+    '''Return the filename of a mip level of a cached texture.'''
+    return os.path.join(directory, f'level{level}.npy')
+
+
+def cachedTexturePath(data, directory='images'):
+    '''Return the texture cache directory of a celestial body's texture.'''
+    key = hashlib.sha256(json.dumps({
+        'version': TEXTURE_VERSION,
+        'textureDigest': datasets.fileDigest(
+            os.path.join(directory, data.texture)
+        ),
+    }, sort_keys=True).encode()).hexdigest()
+
+    stem = os.path.splitext(data.texture)[0]
+    return os.path.join(TEXTURE_CACHE_DIR, f'{stem}-{key[:16]}')
+
+
+def buildTexture(imagePath, path):
+    '''
+    Decode a texture image and write its mip chain to a texture cache
+    directory.
+
+    The levels are written to a temporary directory which is then renamed,
+    so that a texture is never seen half written, even by other processes
+    building the same one.
+    '''
+    import cv2
+
+    image = cv2.imread(imagePath, cv2.IMREAD_COLOR)
+    if image is None:
+        raise OSError(f'Could not read texture image {imagePath}')
+    # Rows are kept top first: after vtkImageFlip of an image read by VTK,
+    # which the viewers used to do, the top row is the first one too
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    height, width = image.shape[:2]
+    size = (2**int(np.log2(width)), 2**int(np.log2(height)))
+
+    tmpPath = f'{path}.tmp{os.getpid()}'
+    shutil.rmtree(tmpPath, ignore_errors=True)
+    os.makedirs(tmpPath)
+
+    level = 0
+    while True:
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        np.save(levelPath(tmpPath, level), image)
+        if size[0] <= MIN_TEXTURE_WIDTH or min(size) == 1:
+            break
+        size = (size[0] // 2, size[1] // 2)
+        level += 1
+
+    try:
+        os.replace(tmpPath, path)
+    except OSError:
+        # Another process has finished building the same texture first
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(tmpPath)
+
+
+def ensureTexture(data, directory='images'):
+    '''
+    Return the texture cache directory of an up to date texture for a
+    celestial body, building it first if it is missing.
+    '''
+    path = cachedTexturePath(data, directory)
+    if not os.path.isdir(path):
+        print(f'Caching texture {path}...')
+        buildTexture(os.path.join(directory, data.texture), path)
+    return path
+
+
+def readLevelShapes(path):
+    '''
+    Return the (height, width, channels) shapes of the mip levels of a
+    cached texture, finest first, without reading them.
+    '''
+    shapes = []
+    while os.path.exists(levelPath(path, len(shapes))):
+        shapes.append(
+            np.load(levelPath(path, len(shapes)), mmap_mode='r').shape
+        )
+    return shapes
+
+
+def pickLevel(shapes, windowSize, maxTextureSize, zoom=2):
+    '''
+    Return the coarsest mip level that still has a texel per pixel when the
+    planet is zoomed `zoom` times past filling a window of the given size,
+    among the levels that fit the maximum texture size of the renderer.
+
+    When the planet fills the window, half of its equator spans about the
+    largest side of the window, so the texture needs about twice as many
+    texels across.
+    '''
+    needed = 2 * max(windowSize) * zoom
+    fitting = [
+        level for level, shape in enumerate(shapes)
+        if max(shape[:2]) <= maxTextureSize
+    ] or [len(shapes) - 1]
+
+    for level in reversed(fitting):
+        if shapes[level][1] >= needed:
+            return level
+    return fitting[0]
+
+
+def readTextureLevel(path, level):
+    '''
+    Read a mip level of a cached texture as VTK image data backed directly
+    by the memory-mapped file.
+    '''
+    pixels = np.load(levelPath(path, level), mmap_mode='r')
+    height, width, channels = pixels.shape
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(width, height, 1)
+    scalars = numpy_support.numpy_to_vtk(
+        pixels.reshape(-1, channels), deep=False
+    )
+    scalars.SetName('Colors')
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+
+def maximumTextureSize(renderWindow):
+    '''
+    Return the largest texture size the renderer of a render window
+    supports, or a common default if its context has not been created yet.
+    '''
+    size = vtk.vtkTextureObject.GetMaximumTextureSize(renderWindow)
+    return size if size > 0 else DEFAULT_MAX_TEXTURE_SIZE
+
+
+def loadTexture(texture, data, renderer, directory='images'):
+    '''
+    Cache a celestial body's texture if needed, and set the image of a
+    vtkTexture to the mip level that suits the render window of a renderer.
+
+    The level is picked when the renderer first draws, when the window has
+    its size and the limits of its graphics context are known.
+    '''
+    path = ensureTexture(data, directory)
+    shapes = readLevelShapes(path)
+
+    def load(caller, ev):
+        renderer.RemoveObserver(observer)
+        renderWindow = renderer.GetRenderWindow()
+        level = pickLevel(
+            shapes, renderWindow.GetSize(), maximumTextureSize(renderWindow)
+        )
+        texture.SetInputData(readTextureLevel(path, level))
+
+    observer = renderer.AddObserver('StartEvent', load)
@@ -0,0 +1,363 @@
+'''
+Local HTTP server of the elevations and tiles of a celestial body.
+
+One server is run per config file. It loads the heights (from the
+topographic map, or the built dataset) and the cached texture once, and
+then serves any number of clients:
+
+    GET  /info                              JSON description of the body
+    GET  /elevation?lon=..&lat=..           JSON elevations in metres, at
+         [&method=nearest|bilinear]         comma-separated coords
+    POST /elevation                         the same, for a JSON body of
+                                            {"lon": [...], "lat": [...]}
+    GET  /tiles/height/{z}/{x}/{y}.npy      float32 heights in metres
+    GET  /tiles/height/{z}/{x}/{y}.png      16 bit heights, hMin to hMax
+    GET  /tiles/texture/{z}/{x}/{y}.png     RGB texture
+
+Tiles are square and equirectangular: at zoom z the body is split into
+2^(z+1) columns of tiles from longitude -180 eastwards, and 2^z rows from
+latitude 90 southwards. Finished tiles are kept in a bounded LRU cache, and
+all sampling and encoding runs in a thread pool, so the event loop only
+ever parses requests and writes responses.
+
+    python tileServer.py data/mars.dat [--host 127.0.0.1] [--port 8000]
+        [--source auto|topo|dataset] [--tile-size 256] [--cache-mb 256]
+        [--threads N]
+'''
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+import textures
+import utils
+
+TILE_PATH = re.compile(
+    r'^/tiles/(height|texture)/(\d+)/(\d+)/(\d+)\.(png|npy)$'
+)
+
+# Largest request body accepted, for POST /elevation
+MAX_BODY_BYTES = 64 * 2**20
+
+STATUS_TEXT = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TileCache:
+    '''
+    LRU cache of encoded tiles, holding at most `maxBytes` of them.
+
+    Concurrent requests for a tile that is not cached yet wait for the same
+    computation rather than each starting their own.
+    '''
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, compute):
+        '''
+        Return the cached tile for a key, or await `compute()` for it and
+        cache the result.
+        '''
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return self.tiles[key]
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        self.misses += 1
+        future = asyncio.ensure_future(compute())
+        self.pending[key] = future
+        try:
+            tile = await asyncio.shield(future)
+        finally:
+            del self.pending[key]
+
+        self.tiles[key] = tile
+        self.size += len(tile[1])
+        while self.size > self.maxBytes and len(self.tiles) > 1:
+            _, (_, evicted) = self.tiles.popitem(last=False)
+            self.size -= len(evicted)
+        return tile
+
+
+class TileServer:
+    '''
+    Serve the elevations and tiles of a celestial body over HTTP. See the
+    module docstring for the endpoints.
+    '''
+    def __init__(self, data, source='auto', tileSize=256,
+                 cacheBytes=256 * 2**20, threads=None):
+        self.data = data
+        self.tileSize = tileSize
+        self.cache = TileCache(cacheBytes)
+        self.executor = ThreadPoolExecutor(threads)
+
+        self.sampler = utils.ElevationSampler(data, source)
+        # Build the lookup structures now, rather than racing to build them
+        # from several threads on the first requests
+        for method in utils.SampleMethod:
+            self.sampler.sample([0], [0], method)
+
+        self.texturePath = textures.ensureTexture(data)
+        self.textureLevels = [
+            np.load(textures.levelPath(self.texturePath, level), mmap_mode='r')
+            for level in range(
+                len(textures.readLevelShapes(self.texturePath))
+            )
+        ]
+
+        # Zoom levels beyond these only magnify the source data
+        if self.sampler.source == 'topo':
+            heightWidth = self.sampler.grid.shape[1]
+        else:
+            # About as many vertices as this lie around the equator
+            heightWidth = np.sqrt(self.sampler.polydata.GetNumberOfPoints())
+        self.maxZoom = {
+            'height': self.zoomForWidth(heightWidth),
+            'texture': self.zoomForWidth(self.textureLevels[0].shape[1]),
+        }
+
+    def zoomForWidth(self, width):
+        '''Return the zoom level whose tiles first show every sample.'''
+        return max(0, int(np.ceil(np.log2(width / (2 * self.tileSize)))))
+
+    def info(self):
+        return {
+            'name': self.data.name,
+            'radius': self.data.R,
+            'hMin': self.data.hMin,
+            'hMax': self.data.hMax,
+            'heightSource': self.sampler.source,
+            'tileSize': self.tileSize,
+            'maxZoom': self.maxZoom,
+            'cache': {
+                'tiles': len(self.cache.tiles), 'bytes': self.cache.size,
+                'hits': self.cache.hits, 'misses': self.cache.misses,
+            },
+        }
+
+    def tileBounds(self, z, x, y):
+        '''Return the west longitude, north latitude and span of a tile.'''
+        span = 180 / 2**z
+        return -180 + x * span, 90 - y * span, span
+
+    def heightTile(self, z, x, y):
+        '''Sample the heights in metres at the pixel centres of a tile.'''
+        west, north, span = self.tileBounds(z, x, y)
+        centres = (np.arange(self.tileSize) + 0.5) * (span / self.tileSize)
+        lmbdas, phis = np.meshgrid(west + centres, north - centres)
+        heights = self.sampler.sample(
+            lmbdas, phis, utils.SampleMethod.BILINEAR
+        )
+        return heights.astype(np.float32)
+
+    def textureTile(self, z, x, y):
+        '''
+        Cut a tile out of the coarsest texture level with enough texels,
+        resized to the tile size.
+        '''
+        needed = 2**(z + 1) * self.tileSize
+        pixels = self.textureLevels[0]
+        for level in reversed(self.textureLevels):
+            if level.shape[1] >= needed:
+                pixels = level
+                break
+
+        height, width = pixels.shape[:2]
+        columns = max(width >> (z + 1), 1)
+        rows = max(height >> z, 1)
+        top = min((y * height) >> z, height - rows)
+        left = min((x * width) >> (z + 1), width - columns)
+        region = np.asarray(pixels[top:top + rows, left:left + columns])
+
+        interpolation = (
+            cv2.INTER_AREA if columns > self.tileSize else cv2.INTER_LINEAR
+        )
+        return cv2.resize(
+            region, (self.tileSize, self.tileSize), interpolation=interpolation
+        )
+
+    def encodeTile(self, kind, z, x, y, fmt):
+        '''Render a tile and return its content type and encoded bytes.'''
+        if kind == 'texture':
+            tile = cv2.cvtColor(self.textureTile(z, x, y), cv2.COLOR_RGB2BGR)
+            return 'image/png', cv2.imencode('.png', tile)[1].tobytes()
+
+        heights = self.heightTile(z, x, y)
+        if fmt == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, heights)
+            return 'application/octet-stream', buffer.getvalue()
+
+        hMin, hMax = self.data.hMin, self.data.hMax
+        levels = (heights - hMin) * (65535 / (hMax - hMin))
+        tile = np.clip(np.rint(levels), 0, 65535).astype(np.uint16)
+        return 'image/png', cv2.imencode('.png', tile)[1].tobytes()
+
+    def elevations(self, lmbdas, phis, method):
+        lmbdas = np.asarray(lmbdas, dtype=np.float64)
+        phis = np.asarray(phis, dtype=np.float64)
+        if lmbdas.shape != phis.shape or lmbdas.ndim != 1:
+            raise HTTPError(400, 'lon and lat must be lists of equal length')
+        heights = self.sampler.sample(lmbdas, phis, method)
+        return json.dumps({'elevations': heights.round(2).tolist()})
+
+    async def run(self, function, *args):
+        '''Run a function in the thread pool.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def route(self, method, target, body):
+        '''Return the status, content type and body of a response.'''
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == '/info':
+            return 200, 'application/json', json.dumps(self.info())
+
+        if url.path == '/elevation':
+            try:
+                sampleMethod = utils.SampleMethod[
+                    query.get('method', ['bilinear'])[0].upper()
+                ]
+                if method == 'POST':
+                    points = await self.run(json.loads, body)
+                    lmbdas, phis = points['lon'], points['lat']
+                elif method == 'GET':
+                    lmbdas = [float(v) for v in query['lon'][0].split(',')]
+                    phis = [float(v) for v in query['lat'][0].split(',')]
+                else:
+                    raise HTTPError(405, f'{method} is not allowed')
+            except (KeyError, ValueError, TypeError) as e:
+                raise HTTPError(400, f'Bad elevation query: {e!r}')
+            return 200, 'application/json', await self.run(
+                self.elevations, lmbdas, phis, sampleMethod
+            )
+
+        match = TILE_PATH.match(url.path)
+        if match is None:
+            raise HTTPError(404, f'No such resource {url.path}')
+        if method != 'GET':
+            raise HTTPError(405, f'{method} is not allowed')
+
+        kind, fmt = match.group(1), match.group(5)
+        z, x, y = (int(v) for v in match.group(2, 3, 4))
+        if z > self.maxZoom[kind] or x >= 2**(z + 1) or y >= 2**z:
+            raise HTTPError(404, f'No {kind} tile {z}/{x}/{y}')
+        if kind == 'texture' and fmt != 'png':
+            raise HTTPError(404, 'Texture tiles are only served as PNG')
+
+        contentType, tile = await self.cache.get(
+            (kind, z, x, y, fmt),
+            lambda: self.run(self.encodeTile, kind, z, x, y, fmt)
+        )
+        return 200, contentType, tile
+
+    async def handle(self, reader, writer):
+        '''Serve the requests of one client connection.'''
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keepAlive = headers.get('connection', '').lower() != 'close'
+                try:
+                    method, target, _ = requestLine.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_BYTES:
+                        keepAlive = False
+                        raise HTTPError(413, 'Request body is too large')
+                    body = await reader.readexactly(length)
+                    status, contentType, content = await self.route(
+                        method, target, body
+                    )
+                except HTTPError as e:
+                    status, contentType = e.status, 'text/plain'
+                    content = str(e)
+                except ValueError as e:
+                    status, contentType = 400, 'text/plain'
+                    content = f'Bad request: {e!r}'
+                    keepAlive = False
+                except Exception as e:
+                    status, contentType = 500, 'text/plain'
+                    content = repr(e)
+
+                if isinstance(content, str):
+                    content = content.encode()
+                writer.write((
+                    f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                    f'Content-Type: {contentType}\r\n'
+                    f'Content-Length: {len(content)}\r\n'
+                    f'Connection: {"keep-alive" if keepAlive else "close"}'
+                    '\r\n\r\n'
+                ).encode('latin-1') + content)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving {self.data.name} on http://{host}:{port}/')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', help='config file of the celestial body')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--source', choices=('auto', 'topo', 'dataset'),
+                        default='auto', help='sample the topographic map or '
+                        'the built dataset (default: the map if available)')
+    parser.add_argument('--tile-size', type=int, default=256, dest='tileSize',
+                        help='width and height of tiles in pixels')
+    parser.add_argument('--cache-mb', type=float, default=256, dest='cacheMb',
+                        help='memory for cached tiles in MiB (default: 256)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='threads that sample and encode tiles')
+    args = parser.parse_args()
+
+    server = TileServer(
+        utils.readDataFile(args.config), args.source, args.tileSize,
+        args.cacheMb * 2**20, args.threads
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
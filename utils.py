@@ -1,4 +1,5 @@
 import numpy as np
+import os
 from enum import Enum, auto
 from collections import namedtuple
 
@@ -10,6 +11,96 @@ class ColorMetric(Enum):
     MAE = auto()
 
 
+class SampleMethod(Enum):
+    NEAREST = auto()
+    BILINEAR = auto()
+
+
+class LODSwitch:
+    '''
+    Switch the input of a VTK pipeline between levels of detail of a planet
+    dataset, based on how large the planet appears on screen.
+
+    The coarsest level whose vertices are no further apart than
+    `pixelsPerVertex` pixels is used. While the camera is being moved
+    `interactivePixelsPerVertex` is used instead, so that coarser levels
+    keep the interaction smooth. `mesh` is the sphere mesh of the levels,
+    as given to makeSphere.
+    '''
+    def __init__(self, levels, radius, pixelsPerVertex=1.5,
+                 interactivePixelsPerVertex=6, mesh='uv'):
+        import vtk
+        self.levels = levels
+        self.radius = radius
+        self.pixelsPerVertex = pixelsPerVertex
+        self.interactivePixelsPerVertex = interactivePixelsPerVertex
+        self.interacting = False
+
+        # Approximate number of vertices around the equator of each level.
+        # A UV sphere has about res^2 points, and an icosphere of frequency
+        # n has 10n^2, with about 2 pi / arctan(2) n around the equator.
+        if mesh == 'icosphere':
+            perSqrtPoint = 2 * np.pi / np.arctan(2) / np.sqrt(10)
+        else:
+            perSqrtPoint = 1
+        self.resolutions = [
+            perSqrtPoint * np.sqrt(level.GetNumberOfPoints())
+            for level in levels
+        ]
+
+        self.producer = vtk.vtkTrivialProducer()
+        self.level = None
+        self.select(0)
+
+    def GetOutputPort(self):
+        return self.producer.GetOutputPort()
+
+    def select(self, level):
+        if level != self.level:
+            self.level = level
+            self.producer.SetOutput(self.levels[level])
+
+    def observe(self, renderer, interactor):
+        '''Pick levels as the renderer draws and the camera is moved.'''
+        style = interactor.GetInteractorStyle()
+        style.AddObserver('StartInteractionEvent', self.startInteraction)
+        style.AddObserver('EndInteractionEvent', self.endInteraction)
+        renderer.AddObserver('StartEvent', self.update)
+
+    def startInteraction(self, caller, ev):
+        self.interacting = True
+
+    def endInteraction(self, caller, ev):
+        self.interacting = False
+
+    def screenDiameter(self, renderer):
+        '''Diameter of the planet (centred at the origin) in pixels.'''
+        cam = renderer.GetActiveCamera()
+        height = renderer.GetSize()[1]
+        if cam.GetParallelProjection():
+            return height * self.radius / cam.GetParallelScale()
+
+        dist = np.linalg.norm(cam.GetPosition())
+        if dist <= self.radius:
+            return np.inf
+        angle = 2 * np.degrees(np.arcsin(self.radius / dist))
+        return height * angle / cam.GetViewAngle()
+
+    def update(self, caller, ev):
+        if self.interacting:
+            pixelsPerVertex = self.interactivePixelsPerVertex
+        else:
+            pixelsPerVertex = self.pixelsPerVertex
+        needed = np.pi * self.screenDiameter(caller) / pixelsPerVertex
+
+        level = 0
+        for i in reversed(range(len(self.levels))):
+            if self.resolutions[i] >= needed:
+                level = i
+                break
+        self.select(level)
+
+
 class SliderCBScaleFactor:
     '''
     Callback for VTK slider that controls the scale factor for the
@@ -28,7 +119,15 @@ class SliderCBScaleFactor:
 
 PlanetData = namedtuple('PlanetData', [
     'hMin', 'hMax', 'R', 'tilt', 'rot',
-    'sfR', 'sf', 'topo', 'texture', 'vtksource', 'res', 'name'
+    'sfR', 'sf', 'topo', 'texture', 'vtksource', 'res', 'name',
+    'sampling', 'topoWidth', 'topoHeight', 'topoDtype', 'lods', 'mesh'
+], defaults=['nearest', None, None, None, 4, 'uv'])
+
+
+# The parts of a visualisation that scripts driving it need: its renderer,
+# render window and interactor, and its sliders and filters by name
+Scene = namedtuple('Scene', [
+    'renderer', 'renderWindow', 'interactor', 'sliders', 'filters'
 ])
 
 
@@ -103,6 +202,148 @@ def geoToCartesian(r, lmbda, phi):
     return x, y, z
 
 
+def cartesianToGeo(x, y, z):
+    '''
+    Convert 3D Cartesian coords. into equivalent geographical coordinates
+    (the inverse of geoToCartesian).
+    '''
+    x, y, z = (np.asarray(c, dtype=np.float64) for c in (x, y, z))
+    r = np.sqrt(x**2 + y**2 + z**2)
+
+    tempR = np.where(r == 0, 1, r)
+    lmbda = np.degrees(np.arctan2(y, x))
+    phi = np.degrees(np.arcsin(np.clip(z / tempR, -1, 1)))
+
+    return r, lmbda, phi
+
+
+def sampleEquirectangular(grid: np.ndarray, lmbda, phi,
+                          method=SampleMethod.NEAREST):
+    '''
+    Sample a regular longitude/latitude grid at the given geographical coords.
+
+    The grid is laid out as in readCylindricalTopo.py: the first row is at
+    latitude -90 and the last at +90, the first column is at longitude -180
+    and the last at +180. Values are either taken from the nearest grid node
+    or bilinearly interpolated between the four surrounding nodes.
+    '''
+    height, width = grid.shape[:2]
+    fx = (np.asarray(lmbda) + 180) * ((width - 1) / 360)
+    fy = (np.asarray(phi) + 90) * ((height - 1) / 180)
+    fx = np.clip(fx, 0, width - 1)
+    fy = np.clip(fy, 0, height - 1)
+
+    if method == SampleMethod.NEAREST:
+        return grid[np.rint(fy).astype(np.intp), np.rint(fx).astype(np.intp)]
+
+    elif method == SampleMethod.BILINEAR:
+        x0 = np.minimum(fx.astype(np.intp), width - 2)
+        y0 = np.minimum(fy.astype(np.intp), height - 2)
+        tx, ty = fx - x0, fy - y0
+
+        bottom = (1 - tx) * grid[y0, x0] + tx * grid[y0, x0 + 1]
+        top = (1 - tx) * grid[y0 + 1, x0] + tx * grid[y0 + 1, x0 + 1]
+        return (1 - ty) * bottom + ty * top
+
+    else:
+        raise LookupError('Invalid sample method given')
+
+
+def openTopoMemmap(data, directory='images'):
+    '''
+    Memory-map a raw (.img/.raw) or NumPy (.npy) topographic map.
+
+    Raw maps have no header, so their size and sample type are taken from
+    the `topoWidth`, `topoHeight` and `topoDtype` config parameters (e.g.
+    `topoDtype = >i2` for the big-endian 16 bit PDS products).
+    '''
+    filename = os.path.join(directory, data.topo)
+    if filename.lower().endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+
+    if data.topoWidth is None or data.topoHeight is None or not data.topoDtype:
+        raise ValueError(
+            f'{data.topo}: topoWidth, topoHeight and topoDtype must be given '
+            'for raw topographic maps'
+        )
+    return np.memmap(
+        filename, dtype=np.dtype(data.topoDtype), mode='r',
+        shape=(int(data.topoHeight), int(data.topoWidth))
+    )
+
+
+def readTopoRows(mmap: np.memmap, start: int, stop: int):
+    '''
+    Read rows [start, stop) of a memory-mapped topographic map into memory.
+
+    The rows are read with a plain file read rather than through the mapping,
+    so that pages of the map which have been processed are not left resident.
+    '''
+    width = mmap.shape[1]
+    rows = np.fromfile(
+        mmap.filename, dtype=mmap.dtype, count=(stop - start) * width,
+        offset=mmap.offset + start * width * mmap.dtype.itemsize
+    )
+    return rows.reshape(-1, width)
+
+
+def readTopoGrid(data, directory='images', tileBytes=64 * 2**20):
+    '''
+    Read the topographic map for a celestial body as an equirectangular grid
+    laid out as expected by sampleEquirectangular, downsized by `sf`.
+
+    Image files are decoded whole. Raw and NumPy maps are memory-mapped and
+    downsized by averaging `sf` x `sf` blocks one tile of rows at a time, so
+    at most `tileBytes` of the full resolution map is held in memory at once.
+    With `sf = 1` the memory-mapped map itself is returned.
+
+    Returns the grid and the (minimum, maximum) of its values.
+    '''
+    if os.path.splitext(data.topo)[1].lower() not in ('.npy', '.img', '.raw'):
+        import cv2
+        og_img = cv2.imread(os.path.join(directory, data.topo), 0)
+        width = int(og_img.shape[1] / data.sf)
+        height = int(og_img.shape[0] / data.sf)
+        img = cv2.resize(
+            og_img, (width, height), interpolation=cv2.INTER_AREA
+        )
+        img = cv2.flip(img, 0)
+        return img, (float(np.min(img)), float(np.max(img)))
+
+    mmap = openTopoMemmap(data, directory)
+    sf = max(1, int(round(data.sf)))
+    height, width = mmap.shape[0] // sf, mmap.shape[1] // sf
+
+    rowBytes = mmap.shape[1] * max(mmap.dtype.itemsize, 4) * sf
+    tileRows = max(1, tileBytes // rowBytes)
+
+    grid = np.empty((height, width), dtype=np.float32) if sf > 1 else None
+    vMin, vMax = np.inf, -np.inf
+    for start in range(0, height, tileRows):
+        stop = min(start + tileRows, height)
+        tile = readTopoRows(mmap, start * sf, stop * sf)
+        if sf > 1:
+            tile = tile[:, :width * sf].astype(np.float32)
+            tile = tile.reshape(stop - start, sf, width, sf).mean(axis=(1, 3))
+            grid[start:stop] = tile
+        vMin = min(vMin, float(tile.min()))
+        vMax = max(vMax, float(tile.max()))
+
+    if sf > 1:
+        return np.ascontiguousarray(grid[::-1]), (vMin, vMax)
+    return mmap[::-1], (vMin, vMax)
+
+
+def topoToHeights(values, valueRange, data):
+    '''
+    Linearly map values read from a topographic map onto elevations in
+    metres, so that the map's value range spans hMin to hMax.
+    '''
+    vMin, vMax = valueRange
+    scale = (data.hMax - data.hMin) / (vMax - vMin)
+    return (values - vMin) * scale + data.hMin
+
+
 def stableUnique(arr: np.ndarray, axis: int):
     '''Return unique elements of arr without changing their order.'''
     u, idx = np.unique(arr, axis=axis, return_index=True)
@@ -173,7 +414,8 @@ def getHemispherePixels(hemisphere: np.ndarray):
 
 
 def findNearestColorIdx(colors: np.ndarray, colormap: np.ndarray,
-                        metric=ColorMetric.L1NORM, weights=[1, 1, 1]):
+                        metric=ColorMetric.L1NORM, weights=[1, 1, 1],
+                        chunkBytes=64 * 2**20):
     '''
     For each color given in a list, find the color in the given colormap
     that it closest resembles and return the index of that color in the
@@ -181,39 +423,46 @@ def findNearestColorIdx(colors: np.ndarray, colormap: np.ndarray,
 
     Finding the "closest" color can be done using multiple metrics and with
     weightings for the different color channels present.
+
+    Each distinct color is only matched once, and colors are compared with
+    the colormap in chunks, so memory use does not grow with the number of
+    colors times the size of the colormap. The chunks are sized so that the
+    differences of a chunk and the temporaries made from them take about
+    `chunkBytes` at most.
     '''
     if metric == ColorMetric.L2NORM:
-        idx = np.linalg.norm(
-            (colormap[np.newaxis, :, :] - colors[:, np.newaxis, :]) * weights,
-            2,
-            axis=-1
-        ).argmin(axis=-1)
+        def distances(diffs):
+            return np.linalg.norm(diffs, 2, axis=-1)
 
     elif metric == ColorMetric.L1NORM:
-        idx = np.linalg.norm(
-            (colormap[np.newaxis, :, :] - colors[:, np.newaxis, :]) * weights,
-            1,
-            axis=-1
-        ).argmin(axis=-1)
+        def distances(diffs):
+            return np.linalg.norm(diffs, 1, axis=-1)
 
     elif metric == ColorMetric.MSE:
-        idx = np.mean(
-            ((colormap[np.newaxis, :, :] -
-              colors[:, np.newaxis, :]) * weights)**2,
-            axis=-1
-        ).argmin(axis=-1)
+        def distances(diffs):
+            return np.mean(diffs**2, axis=-1)
 
     elif metric == ColorMetric.MAE:
-        idx = np.mean(
-            np.abs((colormap[np.newaxis, :, :] -
-                    colors[:, np.newaxis, :]) * weights),
-            axis=-1
-        ).argmin(axis=-1)
+        def distances(diffs):
+            return np.mean(np.abs(diffs), axis=-1)
 
     else:
         raise LookupError('Invalid metric given')
 
-    return idx
+    uniqueColors, inverse = np.unique(colors, axis=0, return_inverse=True)
+
+    # The weighted differences, and a temporary the size of them made by
+    # the weighting or the metric, are alive at once with the unweighted
+    # differences, all as float64
+    chunkSize = max(1, chunkBytes // (3 * colormap.size * 8))
+    idx = np.empty(len(uniqueColors), dtype=np.intp)
+    for start in range(0, len(uniqueColors), chunkSize):
+        chunk = uniqueColors[start:start + chunkSize]
+        idx[start:start + chunkSize] = distances(
+            (colormap[np.newaxis, :, :] - chunk[:, np.newaxis, :]) * weights
+        ).argmin(axis=-1)
+
+    return idx[inverse.reshape(-1)]
 
 
 def getHeightFromCmapIdx(idx, colormap, heightRange):
@@ -226,6 +475,477 @@ def getHeightFromCmapIdx(idx, colormap, heightRange):
     return np.linspace(start, stop, len(colormap))[idx]
 
 
+def makeSphere(radius, res, mesh='uv'):
+    '''
+    Create the VTK sphere that planet datasets are built on, with the given
+    theta and phi resolution.
+
+    The mesh is either a UV sphere from vtkSphereSource ('uv'), or an
+    icosphere ('icosphere') with about the same vertex spacing at the
+    equator, whose near-uniform vertices are not crowded at the poles.
+    Either way, the poles are split between their triangles (see
+    splitPoles).
+    '''
+    if mesh == 'icosphere':
+        return splitPoles(makeIcosphere(radius, icosphereFrequency(res)))
+    if mesh != 'uv':
+        raise ValueError(f'Unknown sphere mesh {mesh!r}')
+
+    import vtk
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(radius)
+    sphereSource.SetStartTheta(1e-5)
+    sphereSource.SetThetaResolution(res)
+    sphereSource.SetPhiResolution(res)
+    sphereSource.Update()
+    return splitPoles(sphereSource.GetOutput())
+
+
+def splitPoles(polydata):
+    '''
+    Return a triangulated sphere with each triangle around its poles given
+    its own copy of the pole vertex, in the same place.
+
+    A pole has no longitude of its own, so a single pole vertex cannot have
+    texture coordinates that suit all the triangles around it. Each copy
+    instead takes those of its own triangle (see sphereTCoords). The copies
+    are placed after the other points, whose order is kept.
+    '''
+    import vtk
+    from vtk.util import numpy_support
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(
+        polydata.GetPolys().GetConnectivityArray()
+    ).reshape(-1, 3)
+
+    atPole = (
+        np.hypot(points[:, 0], points[:, 1]) <= 1e-9 * np.abs(points[:, 2])
+    )
+    inFan = atPole[triangles]
+    keep = np.nonzero(~atPole)[0]
+    order = np.concatenate([keep, triangles[inFan]])
+
+    newIndex = np.empty(len(points), dtype=np.int64)
+    newIndex[keep] = np.arange(len(keep))
+    triangles = newIndex[triangles]
+    triangles[inFan] = len(keep) + np.arange(np.count_nonzero(inFan))
+
+    split = vtk.vtkPolyData()
+    newPoints = vtk.vtkPoints()
+    newPoints.SetData(numpy_support.numpy_to_vtk(points[order], deep=True))
+    split.SetPoints(newPoints)
+    polys = vtk.vtkCellArray()
+    polys.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(
+            np.arange(0, triangles.size + 1, 3, dtype=np.int64), deep=True
+        ),
+        numpy_support.numpy_to_vtkIdTypeArray(triangles.ravel(), deep=True)
+    )
+    split.SetPolys(polys)
+
+    pointData = polydata.GetPointData()
+    for i in range(pointData.GetNumberOfArrays()):
+        array = pointData.GetArray(i)
+        newArray = numpy_support.numpy_to_vtk(
+            numpy_support.vtk_to_numpy(array)[order], deep=True
+        )
+        newArray.SetName(array.GetName())
+        split.GetPointData().AddArray(newArray)
+    if pointData.GetNormals() is not None:
+        split.GetPointData().SetActiveNormals(
+            pointData.GetNormals().GetName()
+        )
+    return split
+
+
+def icosphereFrequency(res):
+    '''
+    Return the (even) number of segments each icosahedron edge is split into
+    for an icosphere with about the same vertex spacing at the equator as a
+    UV sphere of the given theta and phi resolution.
+    '''
+    edgeAngle = np.arctan(2)  # Angle between adjacent icosahedron vertices
+    return max(2, 2 * int(round(res * edgeAngle / (4 * np.pi))))
+
+
+def icosphereMesh(frequency):
+    '''
+    Return the points and triangles of a unit icosphere made by splitting
+    each edge of an icosahedron into `frequency` (even) segments.
+
+    The icosahedron has a vertex at each pole and one at longitude 0, so
+    that the meridian at longitude 0, where the texture coordinates of
+    vtkTextureMapToSphere wrap around, runs along triangle edges. Vertices
+    on it are duplicated, as on the UV sphere, with the copies used by the
+    triangles to its west turned by a tiny angle, so those triangles get
+    texture coordinates near 1 rather than near 0.
+    '''
+    n = frequency
+    lat = np.arctan(0.5)
+    lons = np.radians([0, 72, 144, -144, -72])
+    upper = np.stack([
+        np.cos(lat) * np.cos(lons), np.cos(lat) * np.sin(lons),
+        np.full(5, np.sin(lat))
+    ], axis=-1)
+    north = np.array([[0, 0, 1.0]])
+    # Exact antipodes keep the mesh, and so its bounds, symmetric
+    vertices = np.concatenate([north, upper, -upper, -north])
+    north, upper, lower, south = 0, np.arange(1, 6), np.arange(6, 11), 11
+
+    faces = []
+    for k in range(5):
+        k1 = (k + 1) % 5
+        # The lower ring vertex between upper[k] and upper[k1], and the next
+        lowerBetween, lowerNext = lower[(k + 3) % 5], lower[(k + 4) % 5]
+        faces += [
+            (north, upper[k], upper[k1]),
+            (upper[k], lowerBetween, upper[k1]),
+            (upper[k1], lowerBetween, lowerNext),
+            (south, lowerNext, lowerBetween),
+        ]
+
+    # Triangular grid of each face, in (i, j) steps from its first vertex
+    # towards its second and third
+    i, j = (a.ravel() for a in np.indices((n + 1, n + 1)))
+    inFace = i + j <= n
+    i, j = i[inFace], j[inFace]
+    local = np.full((n + 1, n + 1), -1)
+    local[i, j] = np.arange(len(i))
+
+    up = (i + j) <= n - 1
+    down = (i + j) <= n - 2
+    ui, uj, di, dj = i[up], j[up], i[down], j[down]
+    triangles = np.concatenate([
+        np.stack([local[ui, uj], local[ui + 1, uj], local[ui, uj + 1]], -1),
+        np.stack([local[di + 1, dj], local[di + 1, dj + 1],
+                  local[di, dj + 1]], -1),
+    ])
+
+    # In the faces whose median from the first vertex lies on the seam,
+    # the diagonals along that median are flipped so that it follows edges
+    m = np.arange(n // 2)
+    onMedian = np.concatenate([ui == uj, di == dj])
+    seamTriangles = np.concatenate([
+        np.stack([local[m, m], local[m + 1, m], local[m + 1, m + 1]], -1),
+        np.stack([local[m, m], local[m + 1, m + 1], local[m, m + 1]], -1),
+    ])
+    seamFaceTriangles = np.concatenate(
+        [triangles[~onMedian], seamTriangles]
+    )
+
+    points, cells = [], []
+    for face in faces:
+        a, b, c = vertices[list(face)]
+        isSeamFace = (
+            a[1] == 0 and a[0] >= 0 and np.sign(b[1]) == -np.sign(c[1])
+        )
+        points.append(a + np.outer(i / n, b - a) + np.outer(j / n, c - a))
+        cells.append(
+            (seamFaceTriangles if isSeamFace else triangles) + len(i) *
+            len(cells)
+        )
+    points = np.concatenate(points)
+    points /= np.linalg.norm(points, axis=-1, keepdims=True)
+    cells = np.concatenate(cells)
+
+    # Merge the copies of the points shared by neighbouring faces
+    _, first, inverse = np.unique(
+        np.rint(points * 2**24).astype(np.int64), axis=0,
+        return_index=True, return_inverse=True
+    )
+    points, cells = points[first], inverse.reshape(-1)[cells]
+
+    # Make every triangle anticlockwise seen from outside
+    a, b, c = (points[cells[:, k]] for k in range(3))
+    inward = np.einsum('ij,ij->i', np.cross(b - a, c - a), a) < 0
+    cells[inward] = cells[inward][:, ::-1]
+
+    # Duplicate the seam vertices (except the poles) for triangles west of it
+    onSeam = (np.abs(points[:, 1]) < 1e-9) & (points[:, 0] > 1e-9)
+    points[onSeam, 1] = 0
+    seamIdx = np.nonzero(onSeam)[0]
+    angle = -1e-5
+    rotated = points[seamIdx] @ np.array([
+        [np.cos(angle), np.sin(angle), 0],
+        [-np.sin(angle), np.cos(angle), 0],
+        [0, 0, 1],
+    ])
+    copyOf = np.full(len(points), -1)
+    copyOf[seamIdx] = len(points) + np.arange(len(seamIdx))
+    west = np.any(points[cells][:, :, 1] < 0, axis=-1)
+    westCells = cells[west]
+    westCells[onSeam[westCells]] = copyOf[westCells[onSeam[westCells]]]
+    cells[west] = westCells
+    points = np.concatenate([points, rotated])
+
+    return points, cells
+
+
+def makeIcosphere(radius, frequency):
+    '''
+    Create an icosphere as VTK polydata with point normals, like the output
+    of vtkSphereSource (see icosphereMesh).
+    '''
+    import vtk
+    from vtk.util import numpy_support
+    unitPoints, triangles = icosphereMesh(frequency)
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(
+        (unitPoints * radius).astype(np.float32), deep=True
+    ))
+    polys = vtk.vtkCellArray()
+    polys.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(
+            np.arange(0, triangles.size + 1, 3, dtype=np.int64), deep=True
+        ),
+        numpy_support.numpy_to_vtkIdTypeArray(
+            triangles.astype(np.int64).ravel(), deep=True
+        )
+    )
+    normals = numpy_support.numpy_to_vtk(
+        unitPoints.astype(np.float32), deep=True
+    )
+    normals.SetName('Normals')
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+    polydata.GetPointData().SetNormals(normals)
+    return polydata
+
+
+def heightsToVtkArray(heights: np.ndarray, name='Heights'):
+    '''
+    Wrap a 1D array of heights as a VTK double array without copying it.
+
+    The returned VTK array keeps a reference to the NumPy buffer, so the
+    heights stay valid for as long as the VTK array is alive.
+    '''
+    from vtk.util import numpy_support
+    heights = np.ascontiguousarray(heights, dtype=np.float64)
+    vtkHeights = numpy_support.numpy_to_vtk(heights, deep=False)
+    vtkHeights.SetName(name)
+    return vtkHeights
+
+
+def sphereTCoords(lmbda, phi, triangles=None, name='TCoords'):
+    '''
+    Return the texture coordinates of the points of a sphere at the given
+    geographical coords as a VTK float array.
+
+    s goes from 0 to 1 eastwards from longitude 0, and t from 0 at the north
+    pole to 1 at the south pole, as vtkTextureMapToSphere (with
+    PreventSeamOff) maps a sphere centred at the origin. The copies of the
+    vertices on longitude 0 made by makeSphere, used by the triangles to
+    the west of it, lie at tiny negative longitudes, so they get s near 1
+    and no triangle spans the whole texture.
+
+    Unlike vtkTextureMapToSphere, which gives the poles s = 0, each copy of
+    a pole vertex made by splitPoles gets the mean s of the other two
+    vertices of its triangle, when the sphere's `triangles` are given.
+    '''
+    from vtk.util import numpy_support
+    s = np.mod(np.asarray(lmbda, dtype=np.float64) / 360, 1)
+    if triangles is not None:
+        triangles = np.asarray(triangles).reshape(-1, 3)
+        inFan = (np.abs(np.asarray(phi)) >= 90 - 1e-9)[triangles]
+        fan = np.any(inFan, axis=-1)
+        fanS = s[triangles[fan]]
+        s[triangles[inFan]] = (
+            np.sum(fanS, axis=-1) - fanS[inFan[fan]]
+        ) / 2
+
+    tcoords = np.empty((len(s), 2), dtype=np.float32)
+    tcoords[:, 0] = s
+    tcoords[:, 1] = 0.5 - np.asarray(phi) / 180
+    vtkTCoords = numpy_support.numpy_to_vtk(tcoords, deep=False)
+    vtkTCoords.SetName(name)
+    return vtkTCoords
+
+
+def mapTextureToSphere(lodSwitch):
+    '''
+    Return the output port of a LODSwitch with texture coordinates, and the
+    vtkTextureMapToSphere filter that computes them, if one is needed.
+
+    Datasets built with their texture coordinates (see sphereTCoords) are
+    passed on as they are. Older ones, such as the pre-made datasets in
+    sources/, are mapped by vtkTextureMapToSphere instead.
+    '''
+    import vtk
+    if all(level.GetPointData().GetTCoords() is not None
+           for level in lodSwitch.levels):
+        return lodSwitch.GetOutputPort(), None
+
+    mapToSphere = vtk.vtkTextureMapToSphere()
+    mapToSphere.SetInputConnection(lodSwitch.GetOutputPort())
+    # Centred on the origin rather than on the mean of the points, which is
+    # off it for icospheres, whose seam vertices are duplicated
+    mapToSphere.AutomaticSphereGenerationOff()
+    mapToSphere.SetCenter(0, 0, 0)
+    mapToSphere.PreventSeamOff()
+    return mapToSphere.GetOutputPort(), mapToSphere
+
+
+def sampleNearestHeights(tree, points: np.ndarray, heights: np.ndarray):
+    '''
+    For each point, find the nearest point in the KD-tree and return its
+    height.
+
+    All points are queried in one call that is spread over every available
+    core, rather than one tree lookup per point.
+    '''
+    _, idx = tree.query(points, workers=-1)
+    return heights[idx]
+
+
+class ElevationSampler:
+    '''
+    Sample the elevations of a celestial body, in metres, at large batches
+    of geographical coords.
+
+    The heights are loaded once, from one of two sources:
+
+    - 'topo': the topographic map, read as readCylindricalTopo.py reads it
+      (downsized by `sf`; use a config with `sf = 1` for full resolution).
+      `nearest` takes the nearest grid node, and `bilinear` interpolates
+      between the four surrounding ones.
+    - 'dataset': the built dataset in the build cache, or the pre-made one
+      in sources/ when there is no topographic map. `nearest` takes the
+      nearest sphere vertex, and `bilinear` interpolates linearly within
+      the triangle under the point, as the viewers show the surface.
+
+    'auto' uses the topographic map when it is available. Queries are
+    processed `chunkSize` points at a time to bound memory use.
+    '''
+    def __init__(self, data, source='auto', directory='images',
+                 chunkSize=2**20):
+        self.data = data
+        self.chunkSize = chunkSize
+        if source == 'auto':
+            hasTopo = os.path.exists(os.path.join(directory, data.topo))
+            source = 'topo' if hasTopo else 'dataset'
+        self.source = source
+
+        if source == 'topo':
+            self.grid, self.gridRange = readTopoGrid(data, directory)
+        elif source == 'dataset':
+            import datasets
+            from vtk.util import numpy_support
+            self.polydata = datasets.readDataset(
+                datasets.ensureDataset(data, directory)
+            )
+            self.heights = numpy_support.vtk_to_numpy(
+                self.polydata.GetPointData().GetScalars()
+            ) / data.sfR
+            self.tree = None
+            self.locator = None
+        else:
+            raise ValueError(f'Unknown elevation source {source!r}')
+
+    def sample(self, lmbda, phi, method=SampleMethod.NEAREST):
+        '''
+        Return the elevations in metres at the given longitudes and
+        latitudes in degrees.
+        '''
+        lmbda = np.mod(np.asarray(lmbda, dtype=np.float64) + 180, 360) - 180
+        phi = np.clip(np.asarray(phi, dtype=np.float64), -90, 90)
+        if method not in (SampleMethod.NEAREST, SampleMethod.BILINEAR):
+            raise LookupError('Invalid sample method given')
+
+        heights = np.empty(lmbda.shape)
+        for start in range(0, lmbda.size, self.chunkSize):
+            stop = min(start + self.chunkSize, lmbda.size)
+            heights.flat[start:stop] = self.sampleChunk(
+                lmbda.flat[start:stop], phi.flat[start:stop], method
+            )
+        return heights
+
+    def sampleChunk(self, lmbda, phi, method):
+        if self.source == 'topo':
+            return topoToHeights(
+                sampleEquirectangular(self.grid, lmbda, phi, method),
+                self.gridRange, self.data
+            )
+
+        points = np.column_stack(
+            geoToCartesian(self.data.R * self.data.sfR, lmbda, phi)
+        )
+        if method == SampleMethod.NEAREST:
+            return self.sampleNearestVertex(points)
+        return self.sampleTriangles(points)
+
+    def sampleNearestVertex(self, points):
+        '''Return the heights of the dataset vertices nearest to points.'''
+        if self.tree is None:
+            from scipy import spatial
+            from vtk.util import numpy_support
+            self.tree = spatial.cKDTree(numpy_support.vtk_to_numpy(
+                self.polydata.GetPoints().GetData()
+            ))
+        return sampleNearestHeights(self.tree, points, self.heights)
+
+    def sampleTriangles(self, points):
+        '''
+        Return the heights interpolated within the dataset triangles under
+        points on the sphere, in a single vtkProbeFilter pass.
+        '''
+        import vtk
+        from vtk.util import numpy_support
+        if self.locator is None:
+            self.locator = vtk.vtkStaticCellLocator()
+            self.locator.SetDataSet(self.polydata)
+            self.locator.BuildLocator()
+            self.maxEdge = self.longestEdge()
+
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=False))
+        queries = vtk.vtkPolyData()
+        queries.SetPoints(vtkPoints)
+
+        # Points on the sphere lie just outside the flat triangles, by at
+        # most about edge^2 / 8R. A looser tolerance would let points be
+        # matched to neighbouring triangles, and extrapolated.
+        radius = self.data.R * self.data.sfR
+        probe = vtk.vtkProbeFilter()
+        probe.SetSourceData(self.polydata)
+        probe.SetInputData(queries)
+        probe.SetCellLocator(self.locator)
+        probe.ComputeToleranceOff()
+        probe.SetTolerance(1.5 * self.maxEdge**2 / (8 * radius))
+        probe.Update()
+
+        output = probe.GetOutput().GetPointData()
+        heights = numpy_support.vtk_to_numpy(output.GetScalars())
+        heights = heights / self.data.sfR
+        valid = numpy_support.vtk_to_numpy(
+            output.GetArray(probe.GetValidPointMaskArrayName())
+        ).astype(bool)
+        # Points the probe could not place take the nearest vertex instead
+        if not valid.all():
+            heights[~valid] = self.sampleNearestVertex(points[~valid])
+        # Points placed just outside a triangle are slightly extrapolated
+        return np.clip(heights, self.heights.min(), self.heights.max())
+
+    def longestEdge(self, chunkSize=2**20):
+        '''Return the length of the longest edge of the dataset triangles.'''
+        from vtk.util import numpy_support
+        points = numpy_support.vtk_to_numpy(
+            self.polydata.GetPoints().GetData()
+        )
+        triangles = numpy_support.vtk_to_numpy(
+            self.polydata.GetPolys().GetConnectivityArray()
+        ).reshape(-1, 3)
+
+        longest = 0
+        for start in range(0, len(triangles), chunkSize):
+            corners = points[triangles[start:start + chunkSize]]
+            edges = corners - np.roll(corners, 1, axis=1)
+            longest = max(longest, float(np.max(np.sum(edges**2, axis=-1))))
+        return np.sqrt(longest)
+
+
 def makeVtkSliderRep(title, minValue, maxValue, startValue, x, y):
     '''
     Create a VTK slider representation with a caption, minimum and maximum
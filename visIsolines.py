@@ -1,5 +1,10 @@
-import sys
+import argparse
 import vtk
+import contours
+import datasets
+import filters
+import profiling
+import textures
 import utils
 import numpy as np
 
@@ -18,191 +23,240 @@ class SliderCBTubeRadius:
             tf.SetRadius(value)
 
 
-tubeRadius = 3
-
-# Open and load planet config from file
-dataFile = sys.argv[1]
-data = utils.readDataFile(dataFile)
-hMin = int(np.ceil(data.hMin / 1000)) * 1000
-hMax = int(np.floor(data.hMax / 1000)) * 1000
-
-# Read the polydata from a file
-polyReader = vtk.vtkXMLPolyDataReader()
-polyReader.SetFileName(f'sources/{data.vtksource}')
-polyReader.Update()
-
-ctf = vtk.vtkColorTransferFunction()
-ctf.SetColorSpaceToDiverging()
-ctf.AddRGBPoint(hMin / 1000, 0, 0.1, 0.85)  # Blue
-ctf.AddRGBPoint(hMin * (2 / 3) / 1000, 0.34, 0.55, 1)  # Lighter blue
-ctf.AddRGBPoint(0, 1, 1, 1)  # white
-ctf.AddRGBPoint(hMax / 1000, 0.99, 0.85, 0)  # Yellow
-
-# Read the image data from a file
-textureFilename = f'images/{data.texture}'
-readerFactory = vtk.vtkImageReader2Factory()
-textureReader = readerFactory.CreateImageReader2(textureFilename)
-textureReader.SetFileName(textureFilename)
-textureReader.Update()
-
-# Flip the image for texture mapping
-flip = vtk.vtkImageFlip()
-flip.SetInputConnection(textureReader.GetOutputPort())
-flip.SetFilteredAxis(1)
-
-# Create texture object
-texture = vtk.vtkTexture()
-texture.SetInputConnection(flip.GetOutputPort())
-
-# Map texture to sphere
-mapToSphere = vtk.vtkTextureMapToSphere()
-mapToSphere.SetInputConnection(polyReader.GetOutputPort())
-mapToSphere.PreventSeamOff()
-
-# Create isolines (contours)
-contour = vtk.vtkContourFilter()
-contour.SetInputConnection(mapToSphere.GetOutputPort())
-contourValues = [
-    i // 1000 for i in range(hMin, hMax + 1000, 1000)
-    if i != 0
-]
-for i, v in enumerate(contourValues):
-    contour.SetValue(i, v)
-
-# Get sea level contour
-seaLevel = vtk.vtkContourFilter()
-seaLevel.SetInputConnection(mapToSphere.GetOutputPort())
-seaLevel.SetValue(0, 0)
-
-# Turn contour lines into tubes
-tubeContours = vtk.vtkTubeFilter()
-tubeContours.SetInputConnection(contour.GetOutputPort())
-tubeContours.SetNumberOfSides(6)
-tubeContours.SetRadius(tubeRadius)
-
-tubeSea = vtk.vtkTubeFilter()
-tubeSea.SetInputConnection(seaLevel.GetOutputPort())
-tubeSea.SetNumberOfSides(6)
-tubeSea.SetRadius(tubeRadius)
-
-# Create mapper and set the mapped texture as input
-planetMapper = vtk.vtkPolyDataMapper()
-planetMapper.SetInputConnection(mapToSphere.GetOutputPort())
-planetMapper.ScalarVisibilityOff()  # Important for rendering texture properly
-
-# Create mapper for contours
-contourMapper = vtk.vtkPolyDataMapper()
-contourMapper.SetInputConnection(tubeContours.GetOutputPort())
-contourMapper.SetLookupTable(ctf)
-
-# Create mapper for contours
-seaMapper = vtk.vtkPolyDataMapper()
-seaMapper.SetInputConnection(tubeSea.GetOutputPort())
-
-# Create actors, set mappers and textures
-planetActor = vtk.vtkActor()
-planetActor.SetMapper(planetMapper)
-planetActor.SetTexture(texture)
-planetActor.RotateX(90)
-planetActor.RotateZ(data.rot)
-planetActor.RotateY(data.tilt)
-
-contourActor = vtk.vtkActor()
-contourActor.SetMapper(contourMapper)
-contourActor.SetUserMatrix(planetActor.GetMatrix())
-
-seaActor = vtk.vtkActor()
-seaActor.SetMapper(seaMapper)
-seaActor.SetUserMatrix(planetActor.GetMatrix())
-seaActor.GetProperty().SetColor(1, 0, 0)
-
-# Create legend for contour line colors.
-scalarBar = vtk.vtkScalarBarActor()
-scalarBar.SetLookupTable(contourMapper.GetLookupTable())
-scalarBar.SetTitle('Elevation (km)')
-scalarBar.UnconstrainedFontSizeOn()
-scalarBar.GetTitleTextProperty().SetLineOffset(-20)
-scalarBar.GetTitleTextProperty().SetFontSize(20)
-scalarBar.GetLabelTextProperty().SetFontSize(16)
-scalarBar.SetMaximumWidthInPixels(100)
-scalarBar.SetMaximumHeightInPixels(500)
-scalarBar.SetNumberOfLabels(len(contourValues) + 1)
-scalarBar.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-scalarBar.GetPositionCoordinate().SetValue(0.85, 0.05)
-
-# Create a title that displays the planet name
-titleActor = vtk.vtkTextActor()
-titleActor.SetInput(data.name)
-titleActor.GetTextProperty().SetVerticalJustificationToTop()
-titleActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-titleActor.GetPositionCoordinate().SetValue(0.05, 0.95)
-titleActor.GetTextProperty().SetFontSize(40)
-
-# Add caption to inform user of the red 0km elevation contour
-subtitleActor = vtk.vtkTextActor()
-subtitleActor.SetInput('0km elevation shown in red.')
-subtitleActor.GetTextProperty().SetJustificationToRight()
-subtitleActor.GetTextProperty().SetVerticalJustificationToTop()
-subtitleActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-subtitleActor.GetPositionCoordinate().SetValue(0.95, 0.95)
-subtitleActor.GetTextProperty().SetFontSize(20)
-
-# Create a line that goes through the poles of the planet
-line = vtk.vtkLineSource()
-line.SetPoint1(0, 0, data.R * data.sfR * 1.1)
-line.SetPoint2(0, 0, data.R * data.sfR * -1.1)
-
-lineMapper = vtk.vtkPolyDataMapper()
-lineMapper.SetInputConnection(line.GetOutputPort())
-
-lineActor = vtk.vtkActor()
-lineActor.SetMapper(lineMapper)
-lineActor.GetProperty().SetLineWidth(2)
-lineActor.SetUserMatrix(planetActor.GetMatrix())
-
-# Create a renderer
-renderer = vtk.vtkRenderer()
-renderer.AddActor(planetActor)
-renderer.AddActor(contourActor)
-renderer.AddActor(seaActor)
-renderer.AddActor2D(scalarBar)
-renderer.AddActor2D(titleActor)
-renderer.AddActor2D(subtitleActor)
-renderer.AddActor(lineActor)
-
-# Setup render window
-renderWindow = vtk.vtkRenderWindow()
-renderWindow.AddRenderer(renderer)
-renderWindow.SetSize(1280, 720)
-
-# Setup interactor
-interactor = vtk.vtkRenderWindowInteractor()
-interactor.SetRenderWindow(renderWindow)
-interactor.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
-
-# Setup camera
-activeCam = renderer.GetActiveCamera()
-activeCam.SetThickness(30000)
-activeCam.SetPosition(0, 0, 20000)
-activeCam.SetRoll(180)
-
-renderWindow.Render()
-
-# -- GUI slider --
-# Make rep
-tubeRadiusSliderRep = utils.makeVtkSliderRep(
-    'Contour tube radius', 1, 6, tubeRadius, 0.05, 0.1
-)
-
-# Make widget
-tubeRadiusSlider = vtk.vtkSliderWidget()
-tubeRadiusSlider.SetInteractor(interactor)
-tubeRadiusSlider.SetRepresentation(tubeRadiusSliderRep)
-tubeRadiusSlider.SetAnimationModeToJump()
-tubeRadiusSlider.EnabledOn()
-cb = SliderCBTubeRadius(tubeContours, tubeSea)
-tubeRadiusSlider.AddObserver(vtk.vtkCommand.EndInteractionEvent, cb)
-
-interactor.Initialize()
-renderWindow.Render()
-interactor.Start()
+def readIsolines(data, datasetPath):
+    '''
+    Return the contour heights (in km, excluding sea level) used for the
+    isolines of a celestial body, and the isolines at these heights and at
+    sea level. These are read from the isoline cache of the dataset, and
+    only traced on the topographic map the first time they are needed.
+    '''
+    hMin = int(np.ceil(data.hMin / 1000)) * 1000
+    hMax = int(np.floor(data.hMax / 1000)) * 1000
+    contourValues = [
+        i // 1000 for i in range(hMin, hMax + 1000, 1000)
+        if i != 0
+    ]
+    isolines = contours.ensureIsolines(
+        datasetPath, contourValues + [0], data
+    )
+    return contourValues, isolines
+
+
+def createScene(data, offScreen=False):
+    '''
+    Create the pipeline, renderer, render window, interactor and slider of
+    the visualisation of a celestial body's topography with isolines.
+    '''
+    tubeRadius = 3
+
+    hMin = int(np.ceil(data.hMin / 1000)) * 1000
+    hMax = int(np.floor(data.hMax / 1000)) * 1000
+
+    # Read the levels of detail of the polydata, building them first if the
+    # build cache has no up to date dataset for this config. Contours are
+    # always made from the finest level, so they do not change as the planet
+    # surface switches between levels.
+    datasetPath = datasets.ensureDataset(data)
+    levels = datasets.readLevels(datasetPath)
+    lodSwitch = utils.LODSwitch(levels, data.R * data.sfR, mesh=data.mesh)
+
+    ctf = vtk.vtkColorTransferFunction()
+    ctf.SetColorSpaceToDiverging()
+    ctf.AddRGBPoint(hMin / 1000, 0, 0.1, 0.85)  # Blue
+    ctf.AddRGBPoint(hMin * (2 / 3) / 1000, 0.34, 0.55, 1)  # Lighter blue
+    ctf.AddRGBPoint(0, 1, 1, 1)  # white
+    ctf.AddRGBPoint(hMax / 1000, 0.99, 0.85, 0)  # Yellow
+
+    # Create texture object. Its image is loaded from the texture cache
+    # when the scene is first drawn, at a size that suits the window.
+    texture = vtk.vtkTexture()
+
+    # Map texture to sphere, unless the dataset was built with its texture
+    # coordinates
+    mappedPort, mapToSphere = utils.mapTextureToSphere(lodSwitch)
+
+    # Create isolines (contours), including the sea level contour
+    contourValues, isolines = readIsolines(data, datasetPath)
+
+    contour = vtk.vtkTrivialProducer()
+    contour.SetOutput(contours.isolinesToPolyData(
+        {v: isolines[v] for v in contourValues}
+    ))
+
+    # Get sea level contour
+    seaLevel = vtk.vtkTrivialProducer()
+    seaLevel.SetOutput(contours.isolinesToPolyData({0: isolines[0]}))
+
+    # Turn contour lines into tubes. The tubes are only generated once, and
+    # changing their radius just rescales them in place.
+    tubeContours = filters.ScalableTubeFilter()
+    tubeContours.SetInputConnection(contour.GetOutputPort())
+    tubeContours.SetNumberOfSides(6)
+    tubeContours.SetRadius(tubeRadius)
+
+    tubeSea = filters.ScalableTubeFilter()
+    tubeSea.SetInputConnection(seaLevel.GetOutputPort())
+    tubeSea.SetNumberOfSides(6)
+    tubeSea.SetRadius(tubeRadius)
+
+    # Create mapper and set the mapped texture as input
+    planetMapper = vtk.vtkPolyDataMapper()
+    planetMapper.SetInputConnection(mappedPort)
+    # Important for rendering texture properly
+    planetMapper.ScalarVisibilityOff()
+
+    # Create mapper for contours
+    contourMapper = vtk.vtkPolyDataMapper()
+    contourMapper.SetInputConnection(tubeContours.GetOutputPort())
+    contourMapper.SetLookupTable(ctf)
+
+    # Create mapper for contours
+    seaMapper = vtk.vtkPolyDataMapper()
+    seaMapper.SetInputConnection(tubeSea.GetOutputPort())
+
+    # Create actors, set mappers and textures
+    planetActor = vtk.vtkActor()
+    planetActor.SetMapper(planetMapper)
+    planetActor.SetTexture(texture)
+    planetActor.RotateX(90)
+    planetActor.RotateZ(data.rot)
+    planetActor.RotateY(data.tilt)
+
+    contourActor = vtk.vtkActor()
+    contourActor.SetMapper(contourMapper)
+    contourActor.SetUserMatrix(planetActor.GetMatrix())
+
+    seaActor = vtk.vtkActor()
+    seaActor.SetMapper(seaMapper)
+    seaActor.SetUserMatrix(planetActor.GetMatrix())
+    seaActor.GetProperty().SetColor(1, 0, 0)
+
+    # Create legend for contour line colors.
+    scalarBar = vtk.vtkScalarBarActor()
+    scalarBar.SetLookupTable(contourMapper.GetLookupTable())
+    scalarBar.SetTitle('Elevation (km)')
+    scalarBar.UnconstrainedFontSizeOn()
+    scalarBar.GetTitleTextProperty().SetLineOffset(-20)
+    scalarBar.GetTitleTextProperty().SetFontSize(20)
+    scalarBar.GetLabelTextProperty().SetFontSize(16)
+    scalarBar.SetMaximumWidthInPixels(100)
+    scalarBar.SetMaximumHeightInPixels(500)
+    scalarBar.SetNumberOfLabels(len(contourValues) + 1)
+    scalarBar.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+    scalarBar.GetPositionCoordinate().SetValue(0.85, 0.05)
+
+    # Create a title that displays the planet name
+    titleActor = vtk.vtkTextActor()
+    titleActor.SetInput(data.name)
+    titleActor.GetTextProperty().SetVerticalJustificationToTop()
+    titleActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+    titleActor.GetPositionCoordinate().SetValue(0.05, 0.95)
+    titleActor.GetTextProperty().SetFontSize(40)
+
+    # Add caption to inform user of the red 0km elevation contour
+    subtitleActor = vtk.vtkTextActor()
+    subtitleActor.SetInput('0km elevation shown in red.')
+    subtitleActor.GetTextProperty().SetJustificationToRight()
+    subtitleActor.GetTextProperty().SetVerticalJustificationToTop()
+    subtitleCoord = subtitleActor.GetPositionCoordinate()
+    subtitleCoord.SetCoordinateSystemToNormalizedDisplay()
+    subtitleActor.GetPositionCoordinate().SetValue(0.95, 0.95)
+    subtitleActor.GetTextProperty().SetFontSize(20)
+
+    # Create a line that goes through the poles of the planet
+    line = vtk.vtkLineSource()
+    line.SetPoint1(0, 0, data.R * data.sfR * 1.1)
+    line.SetPoint2(0, 0, data.R * data.sfR * -1.1)
+
+    lineMapper = vtk.vtkPolyDataMapper()
+    lineMapper.SetInputConnection(line.GetOutputPort())
+
+    lineActor = vtk.vtkActor()
+    lineActor.SetMapper(lineMapper)
+    lineActor.GetProperty().SetLineWidth(2)
+    lineActor.SetUserMatrix(planetActor.GetMatrix())
+
+    # Create a renderer
+    renderer = vtk.vtkRenderer()
+    renderer.AddActor(planetActor)
+    renderer.AddActor(contourActor)
+    renderer.AddActor(seaActor)
+    renderer.AddViewProp(scalarBar)
+    renderer.AddViewProp(titleActor)
+    renderer.AddViewProp(subtitleActor)
+    renderer.AddActor(lineActor)
+
+    # Setup render window
+    renderWindow = vtk.vtkRenderWindow()
+    renderWindow.AddRenderer(renderer)
+    renderWindow.SetSize(1280, 720)
+    renderWindow.SetOffScreenRendering(offScreen)
+    textures.loadTexture(texture, data, renderer)
+
+    # Setup interactor
+    interactor = vtk.vtkRenderWindowInteractor()
+    interactor.SetRenderWindow(renderWindow)
+    interactor.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+    lodSwitch.observe(renderer, interactor)
+
+    # Setup camera
+    activeCam = renderer.GetActiveCamera()
+    activeCam.SetThickness(30000)
+    activeCam.SetPosition(0, 0, 20000)
+    activeCam.SetRoll(180)
+
+    renderWindow.Render()
+
+    # -- GUI slider --
+    # Make rep
+    tubeRadiusSliderRep = utils.makeVtkSliderRep(
+        'Contour tube radius', 1, 6, tubeRadius, 0.05, 0.1
+    )
+
+    # Make widget
+    tubeRadiusSlider = vtk.vtkSliderWidget()
+    tubeRadiusSlider.SetInteractor(interactor)
+    tubeRadiusSlider.SetRepresentation(tubeRadiusSliderRep)
+    tubeRadiusSlider.SetAnimationModeToJump()
+    tubeRadiusSlider.EnabledOn()
+    cb = SliderCBTubeRadius(tubeContours, tubeSea)
+    tubeRadiusSlider.AddObserver(vtk.vtkCommand.InteractionEvent, cb)
+
+    return utils.Scene(
+        renderer, renderWindow, interactor,
+        sliders={'tube radius': tubeRadiusSlider},
+        # vtkTextureMapToSphere is only part of the scene for old datasets
+        filters={
+            name: algorithm for name, algorithm in {
+                'mapToSphere': mapToSphere, 'tubeContours': tubeContours,
+                'tubeSea': tubeSea,
+            }.items() if algorithm is not None
+        },
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show the topography of a celestial body with isolines.'
+    )
+    parser.add_argument('config', help='config file of the celestial body')
+    profiling.addProfileArgument(
+        parser, help='show frame times on screen, and save them to REPORT '
+                     'on exit (default: frames.json)'
+    )
+    args = parser.parse_args()
+
+    # Open and load planet config from file
+    data = utils.readDataFile(args.config)
+
+    frameLogPath = profiling.reportPath(args, 'frames.json')
+    frameProfiler = profiling.FrameProfiler(enabled=frameLogPath is not None)
+
+    scene = createScene(data)
+    frameProfiler.observeScene(scene)
+
+    scene.interactor.Initialize()
+    scene.renderWindow.Render()
+    scene.interactor.Start()
+
+    frameProfiler.save(frameLogPath)
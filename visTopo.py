@@ -1,123 +1,158 @@
-import sys
+import argparse
 import vtk
+import datasets
+import filters
+import profiling
+import textures
 import utils
 
-# Open and load planet config from file
-dataFile = sys.argv[1]
-data = utils.readDataFile(dataFile)
-
-# Read the polydata from a file
-polyReader = vtk.vtkXMLPolyDataReader()
-polyReader.SetFileName(f'sources/{data.vtksource}')
-
-# Read the image data from a file
-textureFilename = f'images/{data.texture}'
-readerFactory = vtk.vtkImageReader2Factory()
-textureReader = readerFactory.CreateImageReader2(textureFilename)
-textureReader.SetFileName(textureFilename)
-textureReader.Update()
-
-# Flip the image for texture mapping
-flip = vtk.vtkImageFlip()
-flip.SetInputConnection(textureReader.GetOutputPort())
-flip.SetFilteredAxis(1)
-
-# Create texture object
-texture = vtk.vtkTexture()
-texture.SetInputConnection(flip.GetOutputPort())
-
-# Map texture to sphere
-mapToSphere = vtk.vtkTextureMapToSphere()
-mapToSphere.SetInputConnection(polyReader.GetOutputPort())
-mapToSphere.PreventSeamOff()
-
-# Warp the sphere surface based on the scalar height data
-warp = vtk.vtkWarpScalar()
-warp.SetInputConnection(mapToSphere.GetOutputPort())
-warp.SetScaleFactor(10)
-warp.Update()
-
-# Create mapper and set the mapped texture as input
-planetMapper = vtk.vtkPolyDataMapper()
-planetMapper.SetInputConnection(warp.GetOutputPort())
-planetMapper.ScalarVisibilityOff()  # Important for rendering texture properly
-
-# Create actor and set the mapper and the texture
-planetActor = vtk.vtkActor()
-planetActor.SetMapper(planetMapper)
-planetActor.SetTexture(texture)
-planetActor.RotateX(90)
-planetActor.RotateZ(data.rot)
-planetActor.RotateY(data.tilt)
-
-# Create a title that displays the planet name
-titleActor = vtk.vtkTextActor()
-titleActor.SetInput(data.name)
-titleActor.GetTextProperty().SetVerticalJustificationToTop()
-titleActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-titleActor.GetPositionCoordinate().SetValue(0.05, 0.95)
-titleActor.GetTextProperty().SetFontSize(40)
-
-# Create a line that goes through the poles of the planet
-line = vtk.vtkLineSource()
-line.SetPoint1(0, 0, data.R * data.sfR * 1.1)
-line.SetPoint2(0, 0, data.R * data.sfR * -1.1)
-
-lineMapper = vtk.vtkPolyDataMapper()
-lineMapper.SetInputConnection(line.GetOutputPort())
-
-lineActor = vtk.vtkActor()
-lineActor.SetMapper(lineMapper)
-lineActor.GetProperty().SetLineWidth(2)
-lineActor.SetUserMatrix(planetActor.GetMatrix())
-
-# Create a renderer
-renderer = vtk.vtkRenderer()
-renderer.AddActor(planetActor)
-renderer.AddActor(titleActor)
-renderer.AddActor(lineActor)
-
-# Setup render window
-renderWindow = vtk.vtkRenderWindow()
-renderWindow.AddRenderer(renderer)
-renderWindow.SetSize(1280, 720)
-
-# Setup interactor
-interactor = vtk.vtkRenderWindowInteractor()
-interactor.SetRenderWindow(renderWindow)
-interactor.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
-
-# Setup camera
-activeCam = renderer.GetActiveCamera()
-activeCam.SetThickness(30000)
-activeCam.SetPosition(0, 0, 20000)
-activeCam.SetRoll(180)
-
-renderWindow.Render()
-
-# -- GUI slider --
-# Make rep
-slider = vtk.vtkSliderRepresentation2D()
-slider.SetTitleText('Relief scale factor')
-
-slider.SetMinimumValue(1)
-slider.SetMaximumValue(20)
-slider.SetValue(10)
-
-slider.GetPoint1Coordinate().SetCoordinateSystemToNormalizedDisplay()
-slider.GetPoint1Coordinate().SetValue(0.05, 0.1)
-slider.GetPoint2Coordinate().SetCoordinateSystemToNormalizedDisplay()
-slider.GetPoint2Coordinate().SetValue(0.25, 0.1)
-
-# Make widget
-sfSlider = vtk.vtkSliderWidget()
-sfSlider.SetInteractor(interactor)
-sfSlider.SetRepresentation(slider)
-sfSlider.SetAnimationModeToJump()
-sfSlider.EnabledOn()
-cb = utils.SliderCBScaleFactor(warp)
-sfSlider.AddObserver(vtk.vtkCommand.InteractionEvent, cb)
-
-interactor.Initialize()
-renderWindow.Render()
-interactor.Start()
+
+def createScene(data, offScreen=False):
+    '''
+    Create the pipeline, renderer, render window, interactor and slider of
+    the plain 3D visualisation of a celestial body.
+    '''
+    # Read the levels of detail of the polydata, building them first if the
+    # build cache has no up to date dataset for this config
+    lodSwitch = utils.LODSwitch(
+        datasets.readLevels(datasets.ensureDataset(data)), data.R * data.sfR,
+        mesh=data.mesh
+    )
+
+    # Create texture object. Its image is loaded from the texture cache
+    # when the scene is first drawn, at a size that suits the window.
+    texture = vtk.vtkTexture()
+
+    # Map texture to sphere, unless the dataset was built with its texture
+    # coordinates
+    mappedPort, mapToSphere = utils.mapTextureToSphere(lodSwitch)
+
+    # Warp the sphere surface based on the scalar height data. Changes to
+    # the relief scale factor update the warped points in place.
+    warp = filters.IncrementalWarpScalar()
+    warp.SetInputConnection(mappedPort)
+    warp.SetScaleFactor(10)
+    warp.Update()
+
+    # Create mapper and set the mapped texture as input
+    planetMapper = vtk.vtkPolyDataMapper()
+    planetMapper.SetInputConnection(warp.GetOutputPort())
+    # Important for rendering texture properly
+    planetMapper.ScalarVisibilityOff()
+
+    # Create actor and set the mapper and the texture
+    planetActor = vtk.vtkActor()
+    planetActor.SetMapper(planetMapper)
+    planetActor.SetTexture(texture)
+    planetActor.RotateX(90)
+    planetActor.RotateZ(data.rot)
+    planetActor.RotateY(data.tilt)
+
+    # Create a title that displays the planet name
+    titleActor = vtk.vtkTextActor()
+    titleActor.SetInput(data.name)
+    titleActor.GetTextProperty().SetVerticalJustificationToTop()
+    titleActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+    titleActor.GetPositionCoordinate().SetValue(0.05, 0.95)
+    titleActor.GetTextProperty().SetFontSize(40)
+
+    # Create a line that goes through the poles of the planet
+    line = vtk.vtkLineSource()
+    line.SetPoint1(0, 0, data.R * data.sfR * 1.1)
+    line.SetPoint2(0, 0, data.R * data.sfR * -1.1)
+
+    lineMapper = vtk.vtkPolyDataMapper()
+    lineMapper.SetInputConnection(line.GetOutputPort())
+
+    lineActor = vtk.vtkActor()
+    lineActor.SetMapper(lineMapper)
+    lineActor.GetProperty().SetLineWidth(2)
+    lineActor.SetUserMatrix(planetActor.GetMatrix())
+
+    # Create a renderer
+    renderer = vtk.vtkRenderer()
+    renderer.AddActor(planetActor)
+    renderer.AddActor(titleActor)
+    renderer.AddActor(lineActor)
+
+    # Setup render window
+    renderWindow = vtk.vtkRenderWindow()
+    renderWindow.AddRenderer(renderer)
+    renderWindow.SetSize(1280, 720)
+    renderWindow.SetOffScreenRendering(offScreen)
+    textures.loadTexture(texture, data, renderer)
+
+    # Setup interactor
+    interactor = vtk.vtkRenderWindowInteractor()
+    interactor.SetRenderWindow(renderWindow)
+    interactor.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+    lodSwitch.observe(renderer, interactor)
+
+    # Setup camera
+    activeCam = renderer.GetActiveCamera()
+    activeCam.SetThickness(30000)
+    activeCam.SetPosition(0, 0, 20000)
+    activeCam.SetRoll(180)
+
+    renderWindow.Render()
+
+    # -- GUI slider --
+    # Make rep
+    slider = vtk.vtkSliderRepresentation2D()
+    slider.SetTitleText('Relief scale factor')
+
+    slider.SetMinimumValue(1)
+    slider.SetMaximumValue(20)
+    slider.SetValue(10)
+
+    slider.GetPoint1Coordinate().SetCoordinateSystemToNormalizedDisplay()
+    slider.GetPoint1Coordinate().SetValue(0.05, 0.1)
+    slider.GetPoint2Coordinate().SetCoordinateSystemToNormalizedDisplay()
+    slider.GetPoint2Coordinate().SetValue(0.25, 0.1)
+
+    # Make widget
+    sfSlider = vtk.vtkSliderWidget()
+    sfSlider.SetInteractor(interactor)
+    sfSlider.SetRepresentation(slider)
+    sfSlider.SetAnimationModeToJump()
+    sfSlider.EnabledOn()
+    cb = utils.SliderCBScaleFactor(warp)
+    sfSlider.AddObserver(vtk.vtkCommand.InteractionEvent, cb)
+
+    return utils.Scene(
+        renderer, renderWindow, interactor,
+        sliders={'relief scale factor': sfSlider},
+        # vtkTextureMapToSphere is only part of the scene for old datasets
+        filters={
+            name: algorithm for name, algorithm in {
+                'mapToSphere': mapToSphere, 'warp': warp,
+            }.items() if algorithm is not None
+        },
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show a 3D visualisation of a celestial body.'
+    )
+    parser.add_argument('config', help='config file of the celestial body')
+    profiling.addProfileArgument(
+        parser, help='show frame times on screen, and save them to REPORT '
+                     'on exit (default: frames.json)'
+    )
+    args = parser.parse_args()
+
+    # Open and load planet config from file
+    data = utils.readDataFile(args.config)
+
+    frameLogPath = profiling.reportPath(args, 'frames.json')
+    frameProfiler = profiling.FrameProfiler(enabled=frameLogPath is not None)
+
+    scene = createScene(data)
+    frameProfiler.observeScene(scene)
+
+    scene.interactor.Initialize()
+    scene.renderWindow.Render()
+    scene.interactor.Start()
+
+    frameProfiler.save(frameLogPath)